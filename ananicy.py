@@ -11,22 +11,148 @@ import sys
 import time
 import subprocess
 import json
-import _thread
-import pprint
+import marshal
+import resource
+import tempfile
+import tracemalloc
+import ctypes
+import fnmatch
+import platform
+import select
+import signal
+import socket
+import struct
+import heapq
+import math
+import queue
+import threading
+import zlib
 
 from enum import Enum, unique, Flag, auto
-from time import sleep
 
 
-def is_simple_proc_pid(pid):
-    if not os.path.isdir("/proc/{}".format(pid)):
-        return False
+PROC_FS = "/proc"
+
+
+def read_exe(pid, dir_fd=None, proc_fs=PROC_FS):
+    """ Target of /proc/PID/exe, kernel threads and tasks we can't
+    inspect keep the link path itself
+    """
     try:
-        if not os.path.realpath("/proc/{}/exe".format(pid)):
-            return False
-    except FileNotFoundError as err:
-        return False
-    return True
+        if dir_fd is not None:
+            return os.readlink("{}/exe".format(pid), dir_fd=dir_fd)
+        return os.readlink("{}/{}/exe".format(proc_fs, pid))
+    except OSError:
+        return "{}/{}/exe".format(proc_fs, pid)
+
+
+def read_stat(pid, dir_fd=None, proc_fs=PROC_FS):
+    """ (comm, [fields after comm]) of /proc/PID/stat
+    """
+    if dir_fd is not None:
+        fd = os.open("{}/stat".format(pid), os.O_RDONLY, dir_fd=dir_fd)
+    else:
+        fd = os.open("{}/{}/stat".format(proc_fs, pid), os.O_RDONLY)
+    try:
+        stat = os.read(fd, 4096).decode(errors="replace")
+    finally:
+        os.close(fd)
+    # comm may contain spaces and parentheses
+    end = stat.rindex(')')
+    return stat[stat.index('(') + 1:end], stat[end + 2:].split()
+
+
+def read_start_time(pid, proc_fs=PROC_FS):
+    """ Field 22 of /proc/PID/stat, ticks since boot
+    """
+    return int(read_stat(pid, proc_fs=proc_fs)[1][19])
+
+
+def read_identity(pid, exe, dir_fd=None, proc_fs=PROC_FS):
+    """ (start_time, exe, comm) of process, start time changes if pid
+    was reused, exe or comm if process did exec
+    """
+    comm, fields = read_stat(pid, dir_fd=dir_fd, proc_fs=proc_fs)
+    return int(fields[19]), exe, comm
+
+
+def read_autogroup(pid, proc_fs=PROC_FS):
+    """ {"group": N, "nice": X} from /proc/PID/autogroup,
+    None if process is gone or autogroups are disabled
+    """
+    try:
+        with open("{}/{}/autogroup".format(proc_fs, pid)) as _autogroup:
+            name, _, nice = _autogroup.readline().split()
+        return {"group": int(name.split('-')[-1]), "nice": int(nice)}
+    except (OSError, ValueError):
+        return None
+
+
+CMDLINE_PATTERN_PREFIXES = ("re:", "glob:")
+
+
+def is_cmdline_pattern(cmdline):
+    return cmdline.startswith(CMDLINE_PATTERN_PREFIXES)
+
+
+def compile_cmdline_pattern(pattern):
+    """ "re:REGEX" searched in, "glob:GLOB" matched against whole
+    space joined command line
+    """
+    try:
+        if pattern.startswith("re:"):
+            return re.compile(pattern[len("re:"):])
+        return re.compile("^" + fnmatch.translate(pattern[len("glob:"):]))
+    except re.error as e:
+        raise Failure("Bad cmdline pattern {}: {}".format(pattern, e))
+
+
+# Global inline flags, backreferences and named groups change meaning
+# or fail when pattern becomes one branch of a bigger regex
+STANDALONE_PATTERN = re.compile(r"\(\?[aiLmsux]+\)|\(\?P[<=]|\(\?\(|\\[1-9]")
+
+
+class CmdlineMatcher:
+    """ Cmdline patterns of all rules with same name, joined into one
+    alternation: command line without any match is scanned only once.
+    Patterns which can't be joined are searched one by one
+    """
+
+    def __init__(self, patterns):
+        self.patterns = {
+            pattern: compile_cmdline_pattern(pattern) for pattern in patterns
+        }
+        self.standalone = frozenset(
+            pattern for pattern, regex in self.patterns.items()
+            if STANDALONE_PATTERN.search(regex.pattern))
+        joined = [regex.pattern for pattern, regex in self.patterns.items()
+                  if pattern not in self.standalone]
+        self.combined = None
+        if joined:
+            try:
+                self.combined = re.compile("|".join(
+                    "(?:{})".format(regex) for regex in joined))
+            except re.error as e:
+                raise Failure("Bad cmdline patterns {}: {}".format(
+                    ", ".join(sorted(self.patterns)), e))
+
+    def matching(self, cmdline):
+        """ Set of patterns matching cmdline tuple
+        """
+        joined = " ".join(cmdline)
+        if self.combined is not None and self.combined.search(joined):
+            candidates = self.patterns
+        else:
+            candidates = self.standalone
+        return frozenset(pattern for pattern in candidates
+                         if self.patterns[pattern].search(joined))
+
+
+def format_rule_key(key):
+    name, cmdlines = key
+    if not cmdlines:
+        return name
+    return "{} {}".format(name, " ".join(sorted(cmdlines)))
 
 
 def print_verbose_msg(msg, verbose_opts, key):
@@ -39,6 +165,884 @@ class Failure(Exception):
     pass
 
 
+# ioprio_set, ioprio_get
+IOPRIO_SYSCALLS = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "armv7l": (314, 315),
+    "ppc64le": (273, 274),
+    "s390x": (282, 283),
+}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS = {"none": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+
+SCHED_RESET_ON_FORK = 0x40000000
+SCHED_POLICY = {
+    "other": 0,
+    "normal": 0,
+    "fifo": 1,
+    "rr": 2,
+    "batch": 3,
+    "iso": 4,
+    "idle": 5
+}
+
+
+def ioprio_value(ioclass, ionice):
+    """ (class, level) the kernel ends up with, same defaults as
+    ionice(1): best-effort, level 4
+    """
+    if ioclass is None:
+        ioclass = IOPRIO_CLASS["best-effort"]
+    elif not str(ioclass).isdecimal():
+        try:
+            ioclass = IOPRIO_CLASS[ioclass]
+        except KeyError:
+            raise Failure("unknown ioclass: {}".format(ioclass))
+    ioclass = int(ioclass)
+    if ioclass in (IOPRIO_CLASS["none"], IOPRIO_CLASS["idle"]):
+        ionice = 0
+    elif ionice is None:
+        ionice = 4
+    return ioclass, int(ionice)
+
+
+def sched_value(sched, rtprio):
+    """ (policy, priority) the kernel ends up with
+    """
+    if sched not in SCHED_POLICY:
+        raise Failure("unknown sched: {}".format(sched))
+    prio = 0
+    if sched == "rr" or sched == "fifo":
+        prio = rtprio or 1
+    return SCHED_POLICY[sched], prio
+
+
+class SubprocessBackend:
+    """ Apply attributes by running renice/ionice/schedtool
+    """
+    NAME = "subprocess"
+
+    def set_nice(self, tpid, nice):
+        retcode = subprocess.run(
+            ["renice", "-n", str(nice), "-p",
+             str(tpid)],
+            stdout=subprocess.DEVNULL).returncode
+        if retcode != 0:
+            raise Failure()
+
+    def get_ioprio(self, tpid):
+        try:
+            ret = subprocess.run(["ionice", "-p", str(tpid)],
+                                 check=True,
+                                 stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            raise Failure(e)
+        stdout = ret.stdout.rsplit(': prio ')
+        # can return only ioclass, if process class are idle
+        if len(stdout) == 2:
+            return stdout[0].rstrip(), stdout[1].rstrip()
+        return stdout[0].rstrip(), None
+
+    def set_ioprio(self, tpid, ioclass, ionice):
+        args = []
+        if ionice is not None:
+            args.extend(("-n", str(ionice)))
+        if ioclass is not None:
+            args.extend(("-c", str(ioclass)))
+        retcode = subprocess.run(
+            ["ionice", "-p", str(tpid), *args],
+            stdout=subprocess.DEVNULL).returncode
+        if retcode != 0:
+            raise Failure()
+
+    def set_sched(self, tpid, sched, rtprio):
+        arg_map = {
+            'other': '-N',
+            'normal': '-N',
+            'rr': '-R',
+            'fifo': '-F',
+            'batch': '-B',
+            'iso': '-I',
+            'idle': '-D'
+        }
+        cmd = ["schedtool", arg_map[sched]]
+        if sched == "rr" or sched == "fifo":
+            cmd += ["-p", str(rtprio or 1)]
+        cmd += [str(tpid)]
+        retcode = subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode
+        if retcode != 0:
+            raise Failure()
+
+
+class NativeBackend:
+    """ Apply attributes with setpriority/sched_setscheduler/ioprio_set
+    without forking helpers
+    """
+    NAME = "native"
+
+    def __init__(self):
+        syscalls = IOPRIO_SYSCALLS.get(platform.machine())
+        if not syscalls:
+            raise Failure("ioprio syscalls unknown for {}".format(
+                platform.machine()))
+        self.__nr_ioprio_set, self.__nr_ioprio_get = syscalls
+        self.__libc = ctypes.CDLL(None, use_errno=True)
+
+    def __syscall(self, *args):
+        ret = self.__libc.syscall(*args)
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise Failure(os.strerror(errno))
+        return ret
+
+    def set_nice(self, tpid, nice):
+        try:
+            os.setpriority(os.PRIO_PROCESS, tpid, nice)
+        except OSError as e:
+            raise Failure(e)
+
+    def get_ioprio(self, tpid):
+        ioprio = self.__syscall(self.__nr_ioprio_get, IOPRIO_WHO_PROCESS,
+                                tpid)
+        ioclass = ioprio >> IOPRIO_CLASS_SHIFT
+        names = {v: k for k, v in IOPRIO_CLASS.items()}
+        if ioclass == IOPRIO_CLASS["idle"]:
+            return "idle", None
+        return names.get(ioclass, "none"), str(ioprio & 0xff)
+
+    def set_ioprio(self, tpid, ioclass, ionice):
+        ioclass, ionice = ioprio_value(ioclass, ionice)
+        ioprio = ioclass << IOPRIO_CLASS_SHIFT | ionice
+        self.__syscall(self.__nr_ioprio_set, IOPRIO_WHO_PROCESS, tpid,
+                       ioprio)
+
+    def set_sched(self, tpid, sched, rtprio):
+        policy, prio = sched_value(sched, rtprio)
+        try:
+            os.sched_setscheduler(tpid, policy, os.sched_param(prio))
+        except OSError as e:
+            raise Failure(e)
+
+
+def get_backend(name):
+    if name == NativeBackend.NAME:
+        try:
+            return NativeBackend()
+        except (Failure, OSError) as e:
+            print("Native backend unavailable ({}), use subprocess".format(e),
+                  flush=True)
+    return SubprocessBackend()
+
+
+class ProcConnector:
+    """ Kernel proc connector, reports fork/exec/comm/exit of tasks
+    """
+    NETLINK_CONNECTOR = 11
+    CN_IDX_PROC = 1
+    CN_VAL_PROC = 1
+    PROC_CN_MCAST_LISTEN = 1
+    NLMSG_DONE = 3
+
+    FORK = 0x00000001
+    EXEC = 0x00000002
+    COMM = 0x00000200
+    EXIT = 0x80000000
+
+    NLMSG_HDR = struct.Struct("=IHHII")
+    CN_MSG = struct.Struct("=IIIIHH")
+    EVENT_HDR = struct.Struct("=IIQ")
+    EVENT_IDS = struct.Struct("=II")
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                  self.NETLINK_CONNECTOR)
+        self.sock.bind((0, self.CN_IDX_PROC))
+        op = struct.pack("=I", self.PROC_CN_MCAST_LISTEN)
+        cn_msg = self.CN_MSG.pack(self.CN_IDX_PROC, self.CN_VAL_PROC, 0, 0,
+                                  len(op), 0)
+        nlmsg = self.NLMSG_HDR.pack(
+            self.NLMSG_HDR.size + len(cn_msg) + len(op), self.NLMSG_DONE, 0,
+            0, os.getpid())
+        self.sock.send(nlmsg + cn_msg + op)
+        self.sock.setblocking(False)
+        # Set if kernel dropped events, full rescan is needed
+        self.overrun = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_events(self):
+        """ Drain socket, return list of (event, tgid, tid)
+        """
+        events = []
+        data_offset = (self.NLMSG_HDR.size + self.CN_MSG.size +
+                       self.EVENT_HDR.size)
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS: receive queue overrun
+                self.overrun = True
+                continue
+            offset = 0
+            while offset + data_offset <= len(data):
+                msg_len = self.NLMSG_HDR.unpack_from(data, offset)[0]
+                if msg_len < data_offset:
+                    break
+                what = self.EVENT_HDR.unpack_from(
+                    data, offset + self.NLMSG_HDR.size + self.CN_MSG.size)[0]
+                ids = offset + data_offset
+                if what == self.FORK:
+                    # parent pid/tgid go first
+                    ids += self.EVENT_IDS.size
+                if what in (self.FORK, self.EXEC, self.COMM, self.EXIT):
+                    tid, tgid = self.EVENT_IDS.unpack_from(data, ids)
+                    events.append((what, tgid, tid))
+                offset += (msg_len + 3) & ~3
+        return events
+
+
+class Metrics:
+    """ Counters, gauges and histograms, rendered in
+    Prometheus text exposition format
+    """
+    SECONDS_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    APPLY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                     0.1)
+    # name -> (type, help, buckets)
+    DESCRIPTION = {
+        "ananicy_scan_duration_seconds":
+            ("histogram", "Duration of full /proc scan", SECONDS_BUCKETS),
+        "ananicy_threads_scanned_total":
+            ("counter", "Threads seen by full scans", None),
+        "ananicy_new_tasks_total":
+            ("counter", "Threads found new by scans and proc events", None),
+        "ananicy_scan_new_tasks":
+            ("gauge", "New threads found by last full scan", None),
+        "ananicy_rule_hits_total":
+            ("counter", "Threads matched per rule", None),
+        "ananicy_apply_duration_seconds":
+            ("histogram", "Time to check and apply one attribute",
+             APPLY_BUCKETS),
+        "ananicy_failures_total":
+            ("counter", "Errors while processing threads", None),
+        "ananicy_proc_map_size":
+            ("gauge", "Threads tracked in proc map", None),
+        "ananicy_queue_length":
+            ("gauge", "New threads waiting to be processed", None),
+        "ananicy_queue_latency_seconds":
+            ("histogram", "Time from thread found to processed",
+             SECONDS_BUCKETS),
+        "ananicy_scan_interval_seconds":
+            ("gauge", "Delay till next full scan", None),
+        "ananicy_retry_queue_length":
+            ("gauge", "Threads waiting to retry not applied attributes",
+             None),
+        "ananicy_retry_giveups_total":
+            ("counter", "Threads left not fully applied after all retries",
+             None),
+        "ananicy_cgroup_quota_percent":
+            ("gauge", "Current CPUQuota of adaptive cgroups", None),
+        "ananicy_pressure_percent":
+            ("gauge", "Share of time tasks stalled, per resource", None),
+        "ananicy_apply_queue_length":
+            ("gauge", "Matched threads waiting for apply workers", None),
+        "ananicy_apply_backpressure_seconds_total":
+            ("counter", "Time matching waited for full apply queues", None),
+    }
+
+    def __init__(self):
+        # name -> {labels: value}
+        self.values = {name: {} for name in self.DESCRIPTION}
+
+    def inc(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        series = self.values[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.DESCRIPTION[name][2]
+        labels = tuple(sorted(labels.items()))
+        series = self.values[name]
+        hist = series.get(labels)
+        if hist is None:
+            # bucket counts, sum, count
+            hist = series[labels] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    @staticmethod
+    def __labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n')) for k, v in labels) + "}"
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, buckets) in self.DESCRIPTION.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in self.values[name].items():
+                if kind != "histogram":
+                    lines.append("{}{} {}".format(
+                        name, self.__labels(labels), value))
+                    continue
+                counts, total, count = value
+                for bound, bucket in zip(buckets, counts):
+                    lines.append("{}_bucket{} {}".format(
+                        name, self.__labels(labels, (("le", bound),)), bucket))
+                lines.append("{}_bucket{} {}".format(
+                    name, self.__labels(labels, (("le", "+Inf"),)), count))
+                lines.append("{}_sum{} {}".format(
+                    name, self.__labels(labels), total))
+                lines.append("{}_count{} {}".format(
+                    name, self.__labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """ Minimal HTTP endpoint, served from daemon select() loop:
+    "HOST:PORT" listens on TCP, anything else is a unix socket path
+    """
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        if address.startswith('/') or not port.isdecimal():
+            if os.path.exists(address):
+                os.unlink(address)
+            os.makedirs(os.path.dirname(address), exist_ok=True)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(address)
+            os.chmod(address, 0o660)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host or "127.0.0.1", int(port)))
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle(self, render):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        with conn:
+            # Don't let slow client stall the daemon
+            conn.settimeout(0.5)
+            try:
+                # Any request gets metrics, don't wait for it to arrive
+                self.__drain(conn)
+                body = render().encode()
+                conn.sendall(
+                    b"HTTP/1.0 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n" +
+                    "Content-Length: {}\r\n\r\n".format(len(body)).encode() +
+                    body)
+                conn.shutdown(socket.SHUT_WR)
+                # Unread request would turn close into reset
+                self.__drain(conn)
+            except OSError:
+                pass
+
+    def __drain(self, conn):
+        """ Read whatever client already sent, without waiting
+        """
+        timeout = conn.gettimeout()
+        conn.setblocking(False)
+        try:
+            while conn.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            conn.settimeout(timeout)
+
+
+class ControlClient:
+    """ Connection of ControlServer: request bytes till newline,
+    then answer generator and bytes of it not sent yet
+    """
+    __slots__ = ("conn", "request", "answer", "out", "mid_line", "active")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.request = bytearray()
+        self.answer = None
+        self.out = bytearray()
+        # Part of a line was sent, error line must start a new one
+        self.mid_line = False
+        self.active = time.monotonic()
+
+
+class ControlServer:
+    """ Unix socket served from daemon select() loop: client sends
+    one query line, e.g. "proc 1234", answer is streamed back as
+    JSON lines, connection is closed after it.
+    Sockets are non-blocking, request is read and answer generated
+    one BATCH at a time as client takes it, so slow or idle client
+    never stalls the daemon; client silent for TIMEOUT is dropped
+    """
+    PATH = "/run/ananicy/control.sock"
+    # Lines generated per write
+    BATCH = 256
+    MAX_CLIENTS = 16
+    TIMEOUT = 30.0
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        # socket -> ControlClient
+        self.clients = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readers(self):
+        """ Client sockets waiting for request
+        """
+        return [conn for conn, client in self.clients.items()
+                if client.answer is None]
+
+    def writers(self):
+        """ Client sockets with answer to send
+        """
+        return [conn for conn, client in self.clients.items()
+                if client.answer is not None]
+
+    def handle(self, query, readable=(), writable=()):
+        """ query(*words) returns iterable of JSON serializable objects
+        """
+        if self in readable:
+            self.__accept()
+        for conn, client in list(self.clients.items()):
+            try:
+                if conn in readable and client.answer is None:
+                    self.__read(client, query)
+                if client.answer is not None and (
+                        conn in writable or conn in readable):
+                    self.__write(client)
+            except OSError:
+                self.__close(client)
+        now = time.monotonic()
+        for client in list(self.clients.values()):
+            if now - client.active > self.TIMEOUT:
+                self.__abort(client, "client timed out")
+
+    def __accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        client = ControlClient(conn)
+        self.clients[conn] = client
+        if len(self.clients) > self.MAX_CLIENTS:
+            self.__abort(client, "too many clients")
+
+    def __read(self, client, query):
+        try:
+            data = client.conn.recv(4096)
+        except BlockingIOError:
+            return
+        client.request += data
+        client.active = time.monotonic()
+        # Wait for whole line, unless client is done or line too long
+        if data and b"\n" not in client.request and \
+                len(client.request) < 4096:
+            return
+        line = client.request.split(b"\n", 1)[0]
+        client.answer = self.__answer(
+            query, line.decode(errors="replace").split())
+
+    def __write(self, client):
+        """ Send at most one BATCH, rest when socket is writable again
+        """
+        if not client.out:
+            lines = []
+            for line in client.answer:
+                lines.append(line)
+                if len(lines) >= self.BATCH:
+                    break
+            if not lines:
+                self.__close(client)
+                return
+            client.out += ("\n".join(lines) + "\n").encode()
+        try:
+            sent = client.conn.send(client.out)
+        except BlockingIOError:
+            return
+        if sent:
+            client.mid_line = client.out[sent - 1] != ord("\n")
+            client.active = time.monotonic()
+        del client.out[:sent]
+
+    def __abort(self, client, reason):
+        """ Best effort error line, then drop client
+        """
+        line = json.dumps({"error": "answer cut short: " + reason})
+        if client.mid_line:
+            line = "\n" + line
+        try:
+            client.conn.send((line + "\n").encode())
+        except OSError:
+            pass
+        self.__close(client)
+
+    def __close(self, client):
+        self.clients.pop(client.conn, None)
+        if client.answer is not None:
+            client.answer.close()
+        client.conn.close()
+
+    def __answer(self, query, request):
+        """ JSON lines of answer, a failing query ends it with
+        {"error": ...} line instead of reaching the daemon loop
+        """
+        try:
+            for obj in query(*request):
+                yield json.dumps(obj)
+        except Failure as e:
+            yield json.dumps({"error": str(e)})
+        except Exception as e:
+            print("Error: control query {!r}: {}".format(
+                " ".join(request), e), flush=True)
+            yield json.dumps({"error": str(e)})
+
+
+def control_query(path, request):
+    """ Ask running daemon, yield answer JSON lines as text
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((" ".join(request) + "\n").encode())
+        with sock.makefile('r') as answer:
+            yield from answer
+
+
+class TaskScheduler:
+    """ Queue of new tasks processed in bounded ticks: at most
+    tick_budget seconds of work per tick, the rest spread evenly
+    till next full scan. Oldest first, tasks without rule for their
+    exe name wait up to UNLIKELY_DELAY seconds longer.
+    """
+    UNLIKELY_DELAY = 1.0
+    # Seconds per task before anything was measured
+    TASK_COST = 0.0005
+    # Weight of last sample in moving averages
+    EWMA = 0.3
+
+    def __init__(self, tick_budget=0.05, min_interval=1.0, max_interval=10.0):
+        self.tick_budget = tick_budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # (due, seq, queued, key) heap
+        self.queue = []
+        # key -> tpid, latest one if task was pushed again while queued
+        self.tasks = {}
+        self.seq = 0
+        self.task_cost = self.TASK_COST
+        self.arrival_rate = 0.0
+        self.last_scan = None
+        self.last_tick = 0.0
+
+    def __len__(self):
+        return len(self.queue)
+
+    @property
+    def per_tick(self):
+        """ Tasks expected to fit in one tick
+        """
+        return max(1, int(self.tick_budget / max(self.task_cost, 1e-6)))
+
+    def push(self, tpids, likely, now=None):
+        """ likely(tpid) tells that tpid probably has a rule.
+        Task already queued, e.g. exec before it was processed,
+        keeps its place and is processed once, as the newest tpid
+        """
+        now = time.monotonic() if now is None else now
+        for tpid in tpids:
+            if tpid.key in self.tasks:
+                self.tasks[tpid.key] = tpid
+                continue
+            self.tasks[tpid.key] = tpid
+            due = now if likely(tpid) else now + self.UNLIKELY_DELAY
+            self.seq += 1
+            heapq.heappush(self.queue, (due, self.seq, now, tpid.key))
+
+    def tick(self, process):
+        """ Process queued tasks for up to tick_budget seconds,
+        return [queue latency of each processed task]
+        """
+        start = now = time.monotonic()
+        self.last_tick = start
+        latencies = []
+        while self.queue and now - start < self.tick_budget:
+            _, _, queued, key = heapq.heappop(self.queue)
+            latencies.append(now - queued)
+            process(self.tasks.pop(key))
+            now = time.monotonic()
+        if latencies:
+            self.task_cost += self.EWMA * (
+                (now - start) / len(latencies) - self.task_cost)
+        return latencies
+
+    def next_tick(self, deadline, now=None):
+        """ Monotonic time of next tick, None if queue is empty;
+        remaining work is spread over time left till deadline
+        """
+        if not self.queue:
+            return None
+        now = time.monotonic() if now is None else now
+        ticks = math.ceil(len(self.queue) / self.per_tick)
+        if ticks <= 1:
+            return now
+        horizon = min(deadline - now, self.max_interval)
+        return max(now, self.last_tick + max(horizon, 0) / ticks)
+
+    def scan_interval(self, new_tasks, now=None):
+        """ Next full scan delay: often enough that one scan finds
+        about one tick of work, within [min_interval, max_interval]
+        """
+        now = time.monotonic() if now is None else now
+        if self.last_scan is not None and now > self.last_scan:
+            rate = new_tasks / (now - self.last_scan)
+            self.arrival_rate += self.EWMA * (rate - self.arrival_rate)
+        self.last_scan = now
+        if self.arrival_rate <= 0:
+            return self.max_interval
+        return min(max(self.per_tick / self.arrival_rate, self.min_interval),
+                   self.max_interval)
+
+
+class ApplyPool:
+    """ Worker threads running apply(*job). Jobs of one pid always go
+    to the same worker, so they are applied in submit order; submit()
+    blocks while that worker queue is full
+    """
+
+    def __init__(self, apply, workers=4, queue_size=256, wakeup_fd=None):
+        self.apply = apply
+        self.wakeup_fd = wakeup_fd
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.done = queue.SimpleQueue()
+        # Seconds submit() waited for room in full queues
+        self.blocked = 0.0
+        for num, jobs in enumerate(self.queues):
+            threading.Thread(target=self.__worker, args=(jobs,),
+                             name="apply-{}".format(num), daemon=True).start()
+
+    def __len__(self):
+        return sum(jobs.qsize() for jobs in self.queues)
+
+    def submit(self, pid, job):
+        jobs = self.queues[pid % len(self.queues)]
+        try:
+            jobs.put_nowait(job)
+        except queue.Full:
+            start = time.monotonic()
+            jobs.put(job)
+            self.blocked += time.monotonic() - start
+
+    def __worker(self, jobs):
+        while True:
+            job = jobs.get()
+            try:
+                self.done.put((job, self.apply(*job), None))
+            except Exception as exc:
+                self.done.put((job, None, exc))
+            if jobs.empty() and self.wakeup_fd is not None:
+                try:
+                    os.write(self.wakeup_fd, b"\0")
+                except OSError:
+                    # Pipe full, main loop is awake anyway
+                    pass
+
+    def results(self):
+        """ Yield (job, result, exception) of finished jobs
+        """
+        while True:
+            try:
+                yield self.done.get_nowait()
+            except queue.Empty:
+                return
+
+
+class RetryQueue:
+    """ Tasks left with not applied attributes, retried after
+    BASE_DELAY, doubling up to MAX_DELAY, given up after MAX_ATTEMPTS
+    """
+    BASE_DELAY = 1.0
+    MAX_DELAY = 60.0
+    MAX_ATTEMPTS = 8
+
+    def __init__(self):
+        # (due, seq, key) heap, stale entries skipped on pop
+        self.queue = []
+        self.seq = 0
+        # key -> [attempts, seq of queued retry or None, tpid]
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, tpid, now=None):
+        """ Schedule next attempt, False if task ran out of them
+        """
+        now = time.monotonic() if now is None else now
+        attempts = self.tasks.get(tpid.key, (0,))[0] + 1
+        if attempts > self.MAX_ATTEMPTS:
+            del self.tasks[tpid.key]
+            return False
+        self.seq += 1
+        self.tasks[tpid.key] = [attempts, self.seq, tpid]
+        delay = min(self.BASE_DELAY * 2 ** (attempts - 1), self.MAX_DELAY)
+        heapq.heappush(self.queue, (now + delay, self.seq, tpid.key))
+        return True
+
+    def discard(self, key):
+        self.tasks.pop(key, None)
+
+    def __valid(self, seq, key):
+        task = self.tasks.get(key)
+        return task is not None and task[1] == seq
+
+    def next_due(self):
+        while self.queue and not self.__valid(*self.queue[0][1:]):
+            heapq.heappop(self.queue)
+        return self.queue[0][0] if self.queue else None
+
+    def due(self, now=None):
+        """ Pop tasks whose retry time came, they stay known
+        until discard() or next add()
+        """
+        now = time.monotonic() if now is None else now
+        tpids = []
+        while self.queue and self.queue[0][0] <= now:
+            _, seq, key = heapq.heappop(self.queue)
+            if self.__valid(seq, key):
+                self.tasks[key][1] = None
+                tpids.append(self.tasks[key][2])
+        return tpids
+
+
+def rule_hash(rule):
+    """ Stable 32 bit hash of rule attributes
+    """
+    return zlib.crc32(repr(sorted(rule.items())).encode())
+
+
+class StateJournal:
+    """ Append only file of fully applied threads, lets restarted daemon
+    skip them: RECORD is pid, tid, process start time, rule_hash(),
+    TPID.State. Later records win, file is compacted once it holds
+    many stale ones
+    """
+    RECORD = struct.Struct("=iiQIB")
+
+    def __init__(self, path):
+        self.path = path
+        # (pid, tid) -> rule hash of applied threads
+        self.applied = {}
+        self.records = 0
+        self.buffer = bytearray()
+        self.fd = None
+
+    def load(self):
+        """ Return {(pid, tid): (start_time, rule_hash, state)}
+        """
+        entries = {}
+        try:
+            with open(self.path, 'rb') as _journal_file:
+                data = _journal_file.read()
+        except OSError:
+            return entries
+        size = self.RECORD.size
+        for pid, tid, start, hash, state in self.RECORD.iter_unpack(
+                data[:len(data) - len(data) % size]):
+            entries[(pid, tid)] = (start, hash, state)
+        return entries
+
+    def rewrite(self, entries):
+        """ Replace journal with entries, {(pid, tid): (start_time,
+        rule_hash, state)}, and append to it afterwards
+        """
+        self.close()
+        self.applied = {key: entry[1] for key, entry in entries.items()}
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700,
+                        exist_ok=True)
+            with open(tmp, 'wb') as _journal_file:
+                _journal_file.write(b"".join(
+                    self.RECORD.pack(*key, *entry)
+                    for key, entry in entries.items()))
+            os.replace(tmp, self.path)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                              os.O_CLOEXEC)
+        except OSError as e:
+            print("Can't write journal {}: {}".format(self.path, e),
+                  flush=True)
+            return
+        self.records = len(entries)
+
+    def record(self, pid, tid, start_time, hash, state):
+        if self.fd is None:
+            return
+        self.applied[(pid, tid)] = hash
+        self.buffer += self.RECORD.pack(pid, tid, start_time, hash, state)
+        self.records += 1
+
+    def forget(self, key):
+        self.applied.pop(key, None)
+
+    def stale(self):
+        """ True if compaction would drop most of the file
+        """
+        return self.records > 2 * len(self.applied) + 4096
+
+    def flush(self):
+        if self.fd is None or not self.buffer:
+            return
+        try:
+            os.write(self.fd, self.buffer)
+        except OSError as e:
+            print("Can't write journal {}: {}".format(self.path, e),
+                  flush=True)
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 @unique
 class ProcSchedulerPolicy(Enum):
     NORMAL = 0
@@ -66,20 +1070,36 @@ class TPID:
         SCHED         = auto()
         OOM_SCORE_ADJ = auto()
         CGROUP        = auto()
-        ALLSET        = NICE | IOCLASS | SCHED | OOM_SCORE_ADJ | CGROUP
-
-    def __init__(self, pid: int, tpid: int, verbose_opts={}):
+        AFFINITY      = auto()
+        NUMA          = auto()
+        ALLSET        = (NICE | IOCLASS | SCHED | OOM_SCORE_ADJ | CGROUP |
+                         AFFINITY | NUMA)
+
+    # Attributes kernel keeps per thread group (signal_struct),
+    # setting them from one thread is enough for whole process.
+    # nice, ioprio, sched policy and v1 cgroup tasks are per thread.
+    PROCESS_SCOPE = State.OOM_SCORE_ADJ
+    APPLY_FLAGS = (State.NICE, State.IOCLASS, State.SCHED,
+                   State.OOM_SCORE_ADJ, State.CGROUP, State.NUMA,
+                   State.AFFINITY)
+
+    @staticmethod
+    def state_names(state):
+        return [flag.name for flag in TPID.APPLY_FLAGS if state & flag.value]
+
+    # No per object __dict__, paths are built on use
+    __slots__ = ("verbose_opts", "backend", "pid", "tpid", "proc_fs", "exe",
+                 "_stat", "__cmd", "__ionice", "__ioclass", "__cgroups",
+                 "__state")
+
+    def __init__(self, pid: int, tpid: int, verbose_opts={}, backend=None,
+                 exe=None, proc_fs=PROC_FS):
         self.verbose_opts = verbose_opts
+        self.backend = backend or SubprocessBackend()
         self.pid = pid
         self.tpid = tpid
-        self.prefix = "/proc/{}/task/{}/".format(pid, tpid)
-        self.parent = "/proc/{}/".format(pid)
-        self.exe = "/proc/{}/exe".format(pid)
-        try:
-            self.exe = os.path.realpath("/proc/{}/exe".format(pid))
-        except:
-            pass
-        self.__oom_score_adj = self.prefix + "/oom_score_adj"
+        self.proc_fs = proc_fs
+        self.exe = exe or read_exe(pid, proc_fs=proc_fs)
 
         self._stat = None
         self.__cmd = None
@@ -89,13 +1109,38 @@ class TPID:
 
         self.__state = TPID.State(0)
 
+    @property
+    def prefix(self):
+        return "{}/{}/task/{}/".format(self.proc_fs, self.pid, self.tpid)
+
+    @property
+    def parent(self):
+        return "{}/{}/".format(self.proc_fs, self.pid)
+
+    @property
+    def __oom_score_adj(self):
+        return self.prefix + "/oom_score_adj"
+
+    @property
+    def key(self):
+        """ Key of this thread in Ananicy.proc
+        """
+        return (self.pid, self.tpid)
+
     def exists(self):
-        return os.path.exists("/proc/{}/task/{}".format(self.pid, self.tpid))
+        return os.path.exists(self.prefix)
+
+    @property
+    def start_time(self):
+        return read_start_time(self.pid, proc_fs=self.proc_fs)
 
     @property
     def state(self):
         return self.__state
 
+    def reset_state(self, state=0):
+        self.__state = TPID.State(state)
+
     @property
     def cmd(self):
         if not self.__cmd:
@@ -138,30 +1183,14 @@ class TPID:
         return os.getpriority(os.PRIO_PROCESS, self.tpid)
 
     def nice(self, nice: int):
-        os.setpriority(os.PRIO_PROCESS, self.tpid, nice)
         msg = "renice: {}[{}/{}] -> {}".format(self.cmd, self.pid, self.tpid, nice)
         print_verbose_msg(msg, self.verbose_opts, "apply_nice")
-        retcode = subprocess.run(
-            ["renice", "-n", str(nice), "-p",
-             str(self.pid)],
-            stdout=subprocess.DEVNULL).returncode
-        if retcode != 0:
-            raise Failure()
+        self.backend.set_nice(self.tpid, nice)
         return True
 
     @property
     def autogroup(self):
-        try:
-            with open(self.parent + "/autogroup", 'r') as _autogroup:
-                autogroup = _autogroup.readline().strip('/\n').split(" nice ")
-        except FileNotFoundError:
-            return None
-        try:
-            group_num = int(autogroup[0].split('-')[1])
-            nice = int(autogroup[1])
-        except:
-            return None
-        return { "group": group_num, "nice": nice }
+        return read_autogroup(self.pid, self.proc_fs)
 
     @autogroup.setter
     def autogroup(self, autogroup_nice):
@@ -184,24 +1213,10 @@ class TPID:
         # convert arguments from bytes to strings
         return tuple(arg.decode() for arg in _cmdline)
 
-    def __ionice_cmd(self, tpid):
-        ret = subprocess.run(["ionice", "-p", str(tpid)],
-                             check=True,
-                             stdout=subprocess.PIPE,
-                             universal_newlines=True)
-        return ret
-
     def __get_ioprop(self):
-        ret = self.__ionice_cmd(self.tpid)
-        stdout = ret.stdout.rsplit(': prio ')
-        self.__ioclass = stdout[0].rstrip()
+        self.__ioclass, self.__ionice = self.backend.get_ioprio(self.tpid)
         if self.__ioclass == "none":
             self.__ioclass = "best-effort"
-        # can return only ioclass, if process class are idle
-        if len(stdout) == 2:
-            self.__ionice = stdout[1].rstrip()
-        else:
-            self.__ionice = None
 
     @property
     def ionice(self):
@@ -216,22 +1231,15 @@ class TPID:
         return self.__ioclass
 
     def ioclass(self, ioclass, ionice):
-        args = []
         if ionice is not None:
-            args.extend(("-n", str(ionice)))
             msg = "ionice: {}[{}/{}] -> {}".format(
                     self.cmd, self.pid, self.tpid, ionice)
             print_verbose_msg(msg, self.verbose_opts, "apply_ionice")
         if ioclass is not None:
-            args.extend(("-c", str(ioclass)))
             msg = "ioclass: {}[{}/{}] -> {}".format(
                     self.cmd, self.pid, self.tpid, ioclass)
             print_verbose_msg(msg, self.verbose_opts, "apply_ioclass")
-        retcode = subprocess.run(
-            ["ionice", "-p", str(self.tpid), *args],
-            stdout=subprocess.DEVNULL).returncode
-        if retcode != 0:
-            raise Failure()
+        self.backend.set_ioprio(self.tpid, ioclass, ionice)
         return True
 
     @property
@@ -243,31 +1251,11 @@ class TPID:
         return ProcSchedulerPolicy(_sched).name.lower()
 
     def sched(self, sched, rtprio):
-        arg_map = {
-            'other': '-N',
-            'normal': '-N',
-            'rr': '-R',
-            'fifo': '-F',
-            'batch': '-B',
-            'iso': '-I',
-            'idle': '-D'
-        }
-        sched_arg = arg_map[sched]
-        l_prio = None
-        if sched == "other" and c_sched == "normal":
-            return True
-        if sched == "rr" or sched == "fifo":
-            l_prio = rtprio or 1
-        cmd = ["schedtool", sched_arg]
-        if l_prio:
-            cmd += ["-p", str(l_prio)]
-        cmd += [str(self.pid)]
+        sched_value(sched, rtprio)
         msg = "sched: {}[{}/{}] -> {}".format(self.cmd, self.pid,
                                               self.tpid, sched)
         print_verbose_msg(msg, self.verbose_opts, "apply_sched")
-        retcode = subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode
-        if retcode != 0:
-            raise Failure()
+        self.backend.set_sched(self.tpid, sched, rtprio)
         return True
 
     @property
@@ -284,115 +1272,792 @@ class TPID:
     def cgroups(self, cgroups):
         self.__cgroups = cgroups
         for cgroup in self.__cgroups:
-            cgroup.add_pid(self.tpid)
+            cgroup.add_task(self)
             msg = "Cgroup: {}[{}] added to {}".format(
                 self.cmd, self.tpid, cgroup.name)
             print_verbose_msg(msg, self.verbose_opts, "apply_cgroup")
         return True
 
-    def apply_rules(self, rules, cgroups):
-        # Any not specified rule will be considered applied
-        if rules.get("nice"):
-            if self.nice(rules["nice"]):
-                self.__state = self.__state | TPID.State.NICE
-        else:
-            self.__state = self.__state | TPID.State.NICE
-        if rules.get("ioclass") or rules.get("ionice"):
-            if self.ioclass(rules.get("ioclass"), rules.get("ionice")):
-                self.__state = self.__state | TPID.State.IOCLASS
-        else:
-            self.__state = self.__state | TPID.State.IOCLASS
-        if rules.get("sched"):
-            if self.sched(rules["sched"], rules["rtprio"]):
-                self.__state = self.__state | TPID.State.SCHED
-        else:
-            self.__state = self.__state | TPID.State.SCHED
-        if rules.get("oom_score_adj"):
-            if self.oom_score_adj(rules["oom_score_adj"]):
-                self.__state = self.__state | TPID.State.OOM_SCORE_ADJ
+    # Cheap readers of current values, used to skip no-op applies
+    def get_nice(self):
+        return os.getpriority(os.PRIO_PROCESS, self.tpid)
+
+    def get_ioprio(self):
+        ioclass, ionice = self.backend.get_ioprio(self.tpid)
+        return IOPRIO_CLASS.get(ioclass), int(ionice or 0)
+
+    def get_sched(self):
+        policy = os.sched_getscheduler(self.tpid) & ~SCHED_RESET_ON_FORK
+        return policy, os.sched_getparam(self.tpid).sched_priority
+
+    def get_affinity(self):
+        return os.sched_getaffinity(self.tpid)
+
+    def set_affinity(self, cpus):
+        os.sched_setaffinity(self.tpid, cpus)
+        msg = "affinity: {}[{}/{}] -> {}".format(
+            self.cmd, self.pid, self.tpid, ",".join(map(str, sorted(cpus))))
+        print_verbose_msg(msg, self.verbose_opts, "apply_affinity")
+        return True
+
+    def get_oom_score_adj(self):
+        with open(self.__oom_score_adj, 'r') as _oom_score_adj_file:
+            return int(_oom_score_adj_file.readline().rstrip())
+
+    @property
+    def cgroup_paths(self):
+        """ Lines of /proc/PID/task/TID/cgroup as (controllers, path)
+        """
+        paths = []
+        with open(self.prefix + "/cgroup") as _cgroup_file:
+            for line in _cgroup_file:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                paths.append((controllers, path))
+        return paths
+
+    def apply_rules(self, rules, cgroups, process_applied=None, timings=None,
+                    placement=None, autogroups=None):
+        """ Apply only attributes which differ from current ones.
+        process_applied - process scope attributes already set
+        by sibling threads, updated in place.
+        timings - if set, filled with seconds spent per attribute.
+        placement - Placement resolving "cpus"/"numa".
+        autogroups - AutogroupIndex, nice goes to process autogroup.
+        Return counts of applied, skipped as already set, and
+        avoided as set by sibling thread operations.
+        Attributes in state are not touched again, so retry does only
+        missing ones; first error is raised after all were tried
+        """
+        if autogroups is None:
+            nice = (TPID.State.NICE, ("nice",),
+                    lambda: self.get_nice() == rules["nice"],
+                    lambda: self.nice(rules["nice"]))
         else:
-            self.__state = self.__state | TPID.State.OOM_SCORE_ADJ
-        if rules.get("cgroup"):
-            if self.cgroups([cgroups[rules["cgroup"]]]):
-                self.__state = self.__state | TPID.State.CGROUP
+            # Per thread only if group got other nice from another rule
+            nice = (TPID.State.NICE, ("nice",),
+                    lambda: autogroups.is_set(self, rules["nice"]),
+                    lambda: (autogroups.set_nice(self, rules["nice"]) or
+                             self.nice(rules["nice"])))
+        appliers = (
+            nice,
+            (TPID.State.IOCLASS, ("ioclass", "ionice"),
+             lambda: self.get_ioprio() == ioprio_value(rules.get("ioclass"),
+                                                       rules.get("ionice")),
+             lambda: self.ioclass(rules.get("ioclass"), rules.get("ionice"))),
+            (TPID.State.SCHED, ("sched",),
+             lambda: self.get_sched() == sched_value(rules["sched"],
+                                                     rules["rtprio"]),
+             lambda: self.sched(rules["sched"], rules["rtprio"])),
+            (TPID.State.OOM_SCORE_ADJ, ("oom_score_adj",),
+             lambda: self.get_oom_score_adj() == rules["oom_score_adj"],
+             lambda: self.oom_score_adj(rules["oom_score_adj"])),
+            (TPID.State.CGROUP, ("cgroup",),
+             lambda: cgroups[rules["cgroup"]].has_task(self),
+             lambda: self.cgroups([cgroups[rules["cgroup"]]])),
+            # Before affinity, joining cpuset resets it
+            (TPID.State.NUMA, ("numa",),
+             lambda: (placement.cpuset(rules) is None or
+                      placement.cpuset(rules).has_task(self)),
+             lambda: self.cgroups([placement.cpuset(rules)])),
+            (TPID.State.AFFINITY, ("cpus", "numa"),
+             lambda: self.get_affinity() == placement.cpus(rules),
+             lambda: self.set_affinity(placement.cpus(rules))),
+        )
+        scope = TPID.PROCESS_SCOPE
+        if rules.get("cgroup") and cgroups[rules["cgroup"]].PROCESS_SCOPE:
+            scope = scope | TPID.State.CGROUP
+        if rules.get("numa") and placement is not None and \
+                placement.cpuset(rules) is not None and \
+                placement.cpuset(rules).PROCESS_SCOPE:
+            scope = scope | TPID.State.NUMA
+        counts = {"applied": 0, "skipped": 0, "avoided": 0}
+        error = None
+        for flag, attrs, is_set, apply in appliers:
+            if self.__state & flag:
+                continue
+            if placement is None and flag & (TPID.State.NUMA |
+                                             TPID.State.AFFINITY):
+                self.__state = self.__state | flag
+                continue
+            value = tuple(rules.get(attr) for attr in attrs)
+            # Any not specified rule will be considered applied
+            if not any(value):
+                self.__state = self.__state | flag
+                continue
+            process_scope = flag & scope and process_applied is not None
+            if process_scope and process_applied.get(flag) == value:
+                self.__state = self.__state | flag
+                counts["avoided"] += 1
+                continue
+            start = time.perf_counter()
+            try:
+                if is_set():
+                    self.__state = self.__state | flag
+                    counts["skipped"] += 1
+                elif apply():
+                    self.__state = self.__state | flag
+                    counts["applied"] += 1
+            except (OSError, ValueError, Failure) as e:
+                # ValueError: unexpected output of backend tools
+                error = error or e
+            if timings is not None:
+                timings[flag.name.lower()] = time.perf_counter() - start
+            if not self.__state & flag:
+                continue
+            if process_scope:
+                process_applied[flag] = value
+        if error:
+            raise error
+        return counts
+
+
+def parse_cpulist(text):
+    """ "0-3,8" -> frozenset({0, 1, 2, 3, 8})
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return frozenset(cpus)
+
+
+class CpuTopology:
+    """ Online CPUs, NUMA nodes and SMT siblings, read from
+    /sys/devices/system once. resolve() turns rule "cpus" into
+    CPU set: cpulist "0-3,8", "nodeN", "smt-siblings-off" (first
+    thread of each core) or "all"
+    """
+    SYS_FS = "/sys/devices/system"
+
+    def __init__(self, sys_fs=SYS_FS):
+        self.sys_fs = sys_fs
+        self.__online = None
+        self.__nodes = None
+        # spec -> CPU set
+        self.resolved = {}
+
+    def __read(self, path):
+        with open(self.sys_fs + path) as _cpulist_file:
+            return parse_cpulist(_cpulist_file.readline())
+
+    @property
+    def online(self):
+        if self.__online is None:
+            try:
+                self.__online = self.__read("/cpu/online")
+            except OSError:
+                self.__online = frozenset(range(os.cpu_count()))
+        return self.__online
+
+    @property
+    def nodes(self):
+        """ node number -> CPU set
+        """
+        if self.__nodes is None:
+            nodes = {}
+            try:
+                with os.scandir(self.sys_fs + "/node") as entries:
+                    for entry in entries:
+                        if entry.name.startswith("node") and \
+                                entry.name[4:].isdecimal():
+                            nodes[int(entry.name[4:])] = self.__read(
+                                "/node/{}/cpulist".format(entry.name))
+            except OSError:
+                pass
+            self.__nodes = nodes or {0: self.online}
+        return self.__nodes
+
+    def __siblings_off(self):
+        cpus = set()
+        for cpu in sorted(self.online):
+            try:
+                siblings = self.__read(
+                    "/cpu/cpu{}/topology/thread_siblings_list".format(cpu))
+            except OSError:
+                siblings = frozenset((cpu,))
+            if min(siblings & self.online, default=cpu) == cpu:
+                cpus.add(cpu)
+        return frozenset(cpus)
+
+    def resolve(self, spec):
+        cpus = self.resolved.get(spec)
+        if cpus is not None:
+            return cpus
+        if spec == "all":
+            cpus = self.online
+        elif spec == "smt-siblings-off":
+            cpus = self.__siblings_off()
+        elif spec.startswith("node") and spec[4:].isdecimal():
+            if int(spec[4:]) not in self.nodes:
+                raise Failure('No NUMA node "{}"'.format(spec))
+            cpus = self.nodes[int(spec[4:])]
         else:
-            self.__state = self.__state | TPID.State.CGROUP
+            try:
+                cpus = parse_cpulist(spec) & self.online
+            except ValueError:
+                raise Failure('Bad cpulist "{}"'.format(spec))
+        if not cpus:
+            raise Failure('No online CPUs in "{}"'.format(spec))
+        self.resolved[spec] = cpus
+        return cpus
+
+
+class PressureMonitor:
+    """ Share of time some task stalled on cpu/io/memory since last
+    read(), from "some" total of /proc/pressure/RESOURCE or of
+    RESOURCE.pressure of a v2 cgroup
+    """
+    RESOURCES = ("cpu", "io", "memory")
+
+    def __init__(self, proc_fs=PROC_FS):
+        self.proc_fs = proc_fs
+        # path -> (stall total us, monotonic time)
+        self.last = {}
+
+    def path(self, resource):
+        """ System wide pressure file
+        """
+        return "{}/pressure/{}".format(self.proc_fs, resource)
+
+    def available(self, resource):
+        return os.path.exists(self.path(resource))
+
+    def read(self, path):
+        """ Percent 0..100, None on first read of path
+        """
+        with open(path) as _f:
+            some = _f.readline().split()
+        total = int(some[-1].split('=')[1])
+        now = time.monotonic()
+        last = self.last.get(path)
+        self.last[path] = (total, now)
+        if last is None or now <= last[1]:
+            return None
+        return min(100.0, (total - last[0]) / (now - last[1]) / 10000)
+
+
+class AutogroupIndex:
+    """ Autogroup id -> nice given to it. With autogroups enabled
+    nice only orders threads inside their group, so rule nice is
+    written once to the group instead. Only groups whose every
+    process matched rule with that nice may be claimed, others get
+    nice per thread; claimed group gets back its own nice once that
+    stops being true
+    """
+    SYSCTL = "/proc/sys/kernel/sched_autogroup_enabled"
+
+    def __init__(self):
+        # group -> nice written by us
+        self.groups = {}
+        # group -> nice it had before
+        self.original = {}
+        # group -> nice all its processes want, from last full scan
+        self.eligible = {}
+        self.lock = threading.Lock()
+
+    def is_set(self, tpid, nice):
+        autogroup = tpid.autogroup
+        if autogroup is not None and autogroup["nice"] == nice and \
+                self.groups.get(autogroup["group"]) == nice:
+            return True
+        return tpid.get_nice() == nice
+
+    def set_nice(self, tpid, nice):
+        """ True if autogroup of tpid has nice now, False if group
+        can't be claimed and nice must be set per thread
+        """
+        autogroup = tpid.autogroup
+        if autogroup is None:
+            return False
+        group = autogroup["group"]
+        with self.lock:
+            if self.eligible.get(group) != nice:
+                return False
+            if group not in self.groups:
+                self.groups[group] = nice
+                self.original[group] = autogroup["nice"]
+        if autogroup["nice"] != nice:
+            tpid.autogroup = nice
+            msg = "autogroup: {}[{}] group {} -> {}".format(
+                tpid.cmd, tpid.pid, group, nice)
+            print_verbose_msg(msg, tpid.verbose_opts, "apply_nice")
+        return True
+
+    def update(self, index, eligible, proc_fs=PROC_FS):
+        """ index - autogroup_index() of full scan, eligible - group
+        -> nice wanted by all its processes. Give claimed groups which
+        are no longer eligible their nice back, return their pids
+        """
+        released = {}
+        with self.lock:
+            self.eligible = eligible
+            for group in list(self.groups):
+                if eligible.get(group) == self.groups[group]:
+                    continue
+                del self.groups[group]
+                original = self.original.pop(group)
+                if group in index:
+                    released[group] = (original, index[group]["pids"])
+        pids = []
+        for group, (original, group_pids) in released.items():
+            try:
+                with open("{}/{}/autogroup".format(proc_fs, group_pids[0]),
+                          'w') as _autogroup:
+                    _autogroup.write(str(original))
+            except OSError:
+                pass
+            pids.extend(group_pids)
+        return pids
 
 
 class CgroupController:
     PERIOD_US = 100000
     CGROUP_FS = "/sys/fs/cgroup/"
     TYPE = "cpu"
-
-    def __init__(self, name, cpuquota, update_thread=False):
-        if not os.path.exists(self.CGROUP_FS):
+    # Moves whole process instead of single thread
+    PROCESS_SCOPE = False
+    # Apply workers queue tasks, main loop flushes them
+    PENDING_LOCK = threading.Lock()
+
+    def __init__(self, name, cpuquota, track_tasks=False, cgroup_fs=None):
+        self.cgroup_fs = cgroup_fs or self.CGROUP_FS
+        if not os.path.exists(self.cgroup_fs):
             raise Failure("cgroup fs not mounted")
 
-        if not os.path.exists(self.CGROUP_FS + self.TYPE):
+        if not os.path.exists(self.cgroup_fs + self.TYPE):
             raise Failure("cgroup fs: {} missing".format(self.TYPE))
 
         self.name = name
-        self.work_path = self.CGROUP_FS + self.TYPE + "/" + self.name
+        self.work_path = self.cgroup_fs + self.TYPE + "/" + self.name
         if not os.path.exists(self.work_path):
             os.makedirs(self.work_path)
 
         self.ncpu = os.cpu_count()
+        self.cpuquota = cpuquota
         self.quota_us = self.PERIOD_US * self.ncpu * cpuquota // 100
         self.cpu_shares = 1024 * cpuquota // 100
+        # (min, max, pressure resource, target percent) for adapt()
+        self.adaptive = None
         self.tasks = dict()
-        self.files = {'tasks': self.work_path + "/tasks"}
+        # Migrations queued until flush()
+        self.pending = dict()
+        self.files = {'tasks': self.work_path + "/tasks",
+                      'quota': self.work_path + "/cpu.cfs_quota_us"}
 
         try:
             with open(self.work_path + "/cpu.cfs_period_us", 'w') as fd:
                 fd.write(str(self.PERIOD_US))
-            with open(self.work_path + "/cpu.cfs_quota_us", 'w') as fd:
-                fd.write(str(self.quota_us))
+            with open(self.files["quota"], 'w') as fd:
+                fd.write(self.quota_value())
             with open(self.work_path + "/cpu.shares", 'w') as fd:
                 fd.write(str(self.cpu_shares))
         except PermissionError as e:
             raise Failure(e)
 
-        self.files_mtime = {self.files["tasks"]: 0.0}
+        self.track_tasks = track_tasks
+        if track_tasks:
+            self.load_tasks()
 
-        if update_thread:
-            _thread.start_new_thread(self.__tread_update_tasks, ())
+    def quota_value(self):
+        return str(self.quota_us)
 
-    def __tread_update_tasks(self):
-        tasks_path = self.files["tasks"]
-        while True:
-            while self.files_mtime[tasks_path] == os.path.getmtime(tasks_path):
-                sleep(1)
+    def set_quota(self, cpuquota):
+        self.cpuquota = cpuquota
+        self.quota_us = self.PERIOD_US * self.ncpu * cpuquota // 100
+        try:
+            with open(self.files["quota"], 'w') as fd:
+                fd.write(self.quota_value())
+        except OSError as e:
+            raise Failure(e)
+
+    def adapt(self, pressure):
+        """ AIMD step: halve quota while pressure is above target,
+        else add back a tenth of [min, max]; return True if changed
+        """
+        low, high, _, target, _ = self.adaptive
+        if pressure > target:
+            cpuquota = max(low, self.cpuquota // 2)
+        else:
+            cpuquota = min(high, self.cpuquota + max(1, (high - low) // 10))
+        if cpuquota == self.cpuquota:
+            return False
+        self.set_quota(cpuquota)
+        return True
 
-            self.files_mtime[self.files["tasks"]] = os.path.getmtime(
-                tasks_path)
+    def pressure_sources(self, system):
+        """ (pressure file to follow, file of own stalls to subtract
+        or None). v1 has no per cgroup pressure: system wide one
+        includes stalls of this cgroup own tasks
+        """
+        return system, None
 
-            tasks = {}
-            with open(self.files["tasks"], 'r') as fd:
-                for pid in fd.readlines():
-                    pid = int(pid.strip())
-                    tasks[pid] = True
-            self.tasks = tasks
+    def load_tasks(self):
+        """ Seed membership once, afterwards it is kept up to date
+        by our own writes and forget_task() on exit
+        """
+        tasks = {}
+        with open(self.files["tasks"], 'r') as fd:
+            for pid in fd.readlines():
+                pid = int(pid.strip())
+                tasks[pid] = True
+        self.tasks = tasks
+
+    def forget_task(self, pid, tpid):
+        if not self.track_tasks:
+            return
+        if not self.PROCESS_SCOPE:
+            self.tasks.pop(tpid, None)
+        elif pid == tpid:
+            self.tasks.pop(pid, None)
+
+    def has_task(self, tpid: TPID):
+        if self.track_tasks:
+            return self.pid_in_cgroup(
+                tpid.pid if self.PROCESS_SCOPE else tpid.tpid)
+        for controllers, path in tpid.cgroup_paths:
+            if self.TYPE in controllers.split(','):
+                return path == "/" + self.name
+        return False
 
     def pid_in_cgroup(self, pid):
         return bool(self.tasks.get(int(pid)))
 
+    def add_task(self, tpid: TPID):
+        self.add_pid(tpid.pid if self.PROCESS_SCOPE else tpid.tpid)
+
     def add_pid(self, pid):
+        with self.PENDING_LOCK:
+            self.pending[pid] = True
+
+    def flush(self):
+        """ Migrate queued tasks, one open for whole batch,
+        kernel takes only one pid per write().
+        Return [pid, ...] which could not be moved
+        """
+        if not self.pending:
+            return []
+        with self.PENDING_LOCK:
+            pending = self.pending
+            self.pending = dict()
         try:
-            with open(self.files["tasks"], 'w') as _tasks_file:
-                _tasks_file.write(str(pid))
-        except OSError:
-            pass
+            fd = os.open(self.files["tasks"], os.O_WRONLY)
+        except OSError as e:
+            print("Error: cgroup {}: {}".format(self.name, e), flush=True)
+            return list(pending)
+        failed = []
+        try:
+            for pid in pending:
+                try:
+                    os.write(fd, str(pid).encode())
+                except ProcessLookupError:
+                    # Task exited
+                    continue
+                except OSError:
+                    failed.append(pid)
+                    continue
+                if self.track_tasks:
+                    self.tasks[pid] = True
+        finally:
+            os.close(fd)
+        return failed
+
+
+class CgroupV2Controller(CgroupController):
+    """ Unified hierarchy: cpu.max/cpu.weight, optional io.weight and
+    memory.high, tasks are moved by process (cgroup.procs) or by thread
+    in threaded mode (cgroup.threads)
+    """
+    TYPE = ""
+    PROCESS_SCOPE = True
+
+    def __init__(self, name, cpuquota, io_weight=None, memory_high=None,
+                 threaded=False, track_tasks=False, cgroup_fs=None):
+        self.cgroup_fs = cgroup_fs or self.CGROUP_FS
+        if not os.path.exists(self.cgroup_fs + "cgroup.controllers"):
+            raise Failure("cgroup2 fs not mounted")
+        if threaded and (io_weight or memory_high):
+            raise Failure("io/memory controllers are not threaded")
+
+        self.name = name
+        self.work_path = self.cgroup_fs + self.name
+        self.threaded = threaded
+        self.PROCESS_SCOPE = not threaded
+
+        self.ncpu = os.cpu_count()
+        self.cpuquota = cpuquota
+        self.quota_us = self.PERIOD_US * self.ncpu * cpuquota // 100
+        # cpu.weight 100 is the default, same as cpu.shares 1024
+        self.cpu_weight = max(1, cpuquota)
+        self.io_weight = io_weight
+        self.memory_high = memory_high
+        self.adaptive = None
+        self.tasks = dict()
+        self.pending = dict()
+        tasks_file = "/cgroup.threads" if threaded else "/cgroup.procs"
+        self.files = {'tasks': self.work_path + tasks_file,
+                      'quota': self.work_path + "/cpu.max"}
+
+        controllers = ["cpu"]
+        if io_weight:
+            controllers.append("io")
+        if memory_high:
+            controllers.append("memory")
+
+        try:
+            with open(self.cgroup_fs + "cgroup.subtree_control", 'w') as fd:
+                fd.write(" ".join("+" + c for c in controllers))
+            if not os.path.exists(self.work_path):
+                os.makedirs(self.work_path)
+            if threaded:
+                with open(self.work_path + "/cgroup.type", 'w') as fd:
+                    fd.write("threaded")
+            with open(self.files["quota"], 'w') as fd:
+                fd.write(self.quota_value())
+            with open(self.work_path + "/cpu.weight", 'w') as fd:
+                fd.write(str(self.cpu_weight))
+            if io_weight:
+                with open(self.work_path + "/io.weight", 'w') as fd:
+                    fd.write("default {}".format(io_weight))
+            if memory_high:
+                with open(self.work_path + "/memory.high", 'w') as fd:
+                    fd.write(str(memory_high))
+        except OSError as e:
+            raise Failure(e)
+
+        self.track_tasks = track_tasks
+        if track_tasks:
+            self.load_tasks()
+
+    def quota_value(self):
+        return "{} {}".format(self.quota_us, self.PERIOD_US)
+
+    def pressure_sources(self, system):
+        """ Pressure outside of this cgroup: of "PressureCgroup" if
+        set, else system wide minus stalls of own tasks
+        """
+        resource = self.adaptive[2]
+        if self.adaptive[4]:
+            return "{}{}/{}.pressure".format(
+                self.cgroup_fs, self.adaptive[4], resource), None
+        return system, "{}/{}.pressure".format(self.work_path, resource)
+
+    def has_task(self, tpid: TPID):
+        if self.track_tasks:
+            return super().has_task(tpid)
+        for controllers, path in tpid.cgroup_paths:
+            if not controllers:
+                return path == "/" + self.name
+        return False
+
+
+class CpusetController(CgroupController):
+    """ v1 cpuset group holding CPUs and memory of one NUMA node,
+    tasks are moved right away: attach resets CPU affinity, so it
+    must happen before affinity is set
+    """
+    TYPE = "cpuset"
+
+    def __init__(self, numa, cpus, cgroup_fs=None):
+        self.cgroup_fs = cgroup_fs or self.CGROUP_FS
+        if not os.path.exists(self.cgroup_fs + self.TYPE):
+            raise Failure("cgroup fs: {} missing".format(self.TYPE))
+        self.name = "ananicy-" + numa
+        self.work_path = self.cgroup_fs + self.TYPE + "/" + self.name
+        self.adaptive = None
+        self.track_tasks = False
+        self.tasks = dict()
+        self.pending = dict()
+        self.files = {'tasks': self.work_path + "/tasks"}
+        try:
+            if not os.path.exists(self.work_path):
+                os.makedirs(self.work_path)
+            with open(self.work_path + "/cpuset.cpus", 'w') as fd:
+                fd.write(",".join(str(cpu) for cpu in sorted(cpus)))
+            with open(self.work_path + "/cpuset.mems", 'w') as fd:
+                fd.write(numa[4:])
+        except OSError as e:
+            raise Failure(e)
+
+    def add_pid(self, pid):
+        with open(self.files["tasks"], 'w') as fd:
+            fd.write(str(pid))
+
+
+class CpusetV2Controller(CpusetController):
+    """ cpuset of one NUMA node on unified hierarchy, whole process
+    is moved (cgroup.procs), so it leaves its other cgroup
+    """
+    TYPE = ""
+    PROCESS_SCOPE = True
+
+    def __init__(self, numa, cpus, cgroup_fs=None):
+        self.cgroup_fs = cgroup_fs or self.CGROUP_FS
+        try:
+            with open(self.cgroup_fs + "cgroup.controllers") as fd:
+                if "cpuset" not in fd.read().split():
+                    raise Failure("cgroup2: cpuset controller missing")
+        except OSError as e:
+            raise Failure(e)
+        self.name = "ananicy-" + numa
+        self.work_path = self.cgroup_fs + self.name
+        self.adaptive = None
+        self.track_tasks = False
+        self.tasks = dict()
+        self.pending = dict()
+        self.files = {'tasks': self.work_path + "/cgroup.procs"}
+        try:
+            with open(self.cgroup_fs + "cgroup.subtree_control", 'w') as fd:
+                fd.write("+cpuset")
+            if not os.path.exists(self.work_path):
+                os.makedirs(self.work_path)
+            with open(self.work_path + "/cpuset.cpus", 'w') as fd:
+                fd.write(",".join(str(cpu) for cpu in sorted(cpus)))
+            with open(self.work_path + "/cpuset.mems", 'w') as fd:
+                fd.write(numa[4:])
+        except OSError as e:
+            raise Failure(e)
+
+    def has_task(self, tpid: TPID):
+        for controllers, path in tpid.cgroup_paths:
+            if not controllers:
+                return path == "/" + self.name
+        return False
+
+
+def cpuset_controller(numa, cpus, cgroup_fs=None):
+    """ Pick cpuset matching mounted hierarchy
+    """
+    cgroup_fs = cgroup_fs or CgroupController.CGROUP_FS
+    if os.path.exists(cgroup_fs + "cgroup.controllers"):
+        return CpusetV2Controller(numa, cpus, cgroup_fs)
+    return CpusetController(numa, cpus, cgroup_fs)
+
+
+class Placement:
+    """ Rule "cpus"/"numa" to CPU affinity and NUMA cpuset
+    """
+
+    def __init__(self, topology):
+        self.topology = topology
+        # "nodeN" -> CpusetController, None if cpusets are unavailable
+        self.cpusets = {}
+
+    def cpus(self, rules):
+        return self.topology.resolve(rules.get("cpus") or rules["numa"])
+
+    def cpuset(self, rules):
+        return self.cpusets.get(rules["numa"])
+
+    def load_cpusets(self, rules, cgroup_fs=None):
+        """ Create cpuset of every node used by rules
+        """
+        for numa in {rule.get("numa") for rule in rules.values()}:
+            if not numa or numa in self.cpusets:
+                continue
+            try:
+                self.cpusets[numa] = cpuset_controller(
+                    numa, self.topology.resolve(numa), cgroup_fs)
+            except Failure as e:
+                print("No cpuset for {} ({}), NUMA placement by CPU "
+                      "affinity only".format(numa, e), flush=True)
+                self.cpusets[numa] = None
+
+
+def cgroup_controller(name, cpuquota, io_weight=None, memory_high=None,
+                      threaded=False, track_tasks=False, cgroup_fs=None):
+    """ Pick controller matching mounted hierarchy
+    """
+    cgroup_fs = cgroup_fs or CgroupController.CGROUP_FS
+    if os.path.exists(cgroup_fs + "cgroup.controllers"):
+        return CgroupV2Controller(name, cpuquota, io_weight, memory_high,
+                                  threaded, track_tasks, cgroup_fs)
+    if io_weight or memory_high or threaded:
+        raise Failure('"IOWeight", "MemoryHigh", "Threaded" need cgroup v2')
+    return CgroupController(name, cpuquota, track_tasks, cgroup_fs)
+
+
+class SimulatedCgroup(CgroupController):
+    """ Cgroup for replay: same name and membership checks,
+    nothing is created or written under cgroup fs
+    """
+
+    def __init__(self, name, cpuquota, **_):
+        self.name = name
+        self.cpuquota = cpuquota
+        self.adaptive = None
+        self.track_tasks = False
+        self.tasks = dict()
+        self.pending = dict()
+
+    def set_quota(self, cpuquota):
+        self.cpuquota = cpuquota
+
+    def add_pid(self, pid):
+        pass
 
 
 class Ananicy:
-    def __init__(self, config_dir="/etc/ananicy.d/", daemon=True):
+    # Bump when layout of cached types/rules changes
+    RULES_CACHE_VERSION = 3
+
+    def __init__(self, config_dir="/etc/ananicy.d/", daemon=True,
+                 proc_fs=PROC_FS, cgroup_fs=CgroupController.CGROUP_FS,
+                 rules_cache=None, simulate=False):
+        """ proc_fs, cgroup_fs - where /proc and /sys/fs/cgroup/ are,
+        rules_cache - overrides rules_cache from ananicy.conf,
+        simulate - don't create cgroups/cpusets, for record/replay
+        """
         self.dir_must_exits(config_dir)
         self.config_dir = config_dir
+        self.proc_fs = proc_fs
+        self.cgroup_fs = cgroup_fs
+        self.simulate = simulate
         self.cgroups = {}
         self.types = {}
         self.rules = {}
+        # path -> {"stat": (mtime_ns, size), "rules": {...}}
+        self.rule_files = {}
+        # path -> (mtime_ns, size) of all .cgroups/.types/.rules files
+        self.config_stat = {}
+        self.reload_pending = False
+        self.rule_index = {}
+        # name -> CmdlineMatcher for rules with cmdline patterns
+        self.cmdline_matchers = {}
+        # (pid, tpid) -> TPID.State value
         self.proc = {}
+        # pid -> read_identity(), tells that pid was reused or did exec
+        self.proc_ids = {}
+        # pid -> rule match results shared by all threads of process
+        self.rule_cache = {}
+        self.scan_gen = 0
+        self.apply_stats = {"threads": 0, "avoided": 0, "rules": set()}
+        # rule key -> counts of applied/skipped/avoided operations
+        self.rule_stats = {}
+        self.metrics = Metrics()
+        self.metrics_listen = ""
         self.check_freq = 5
+        self.check_freq_min = 1
+        self.tick_budget = 0.05
+        self.apply_workers = 4
+        self.apply_queue = 256
+        self.apply_pool = None
+        self.retries = RetryQueue()
+        self.journal_path = "/run/ananicy/journal"
+        self.control_path = ControlServer.PATH
+        self.pressure_freq = 2
+        self.autogroup_mode = False
+        self.autogroups = None
+        self.topology = CpuTopology()
+        self.placement = Placement(self.topology)
+        self.pressure = PressureMonitor(proc_fs)
+        self.scheduler = None
+        self.journal = None
+        self.proc_events = False
+        self.reconcile_freq = 60
+        self.backend_name = NativeBackend.NAME
+        self.rules_cache = "/var/cache/ananicy/rules.cache"
         self.verbose = {
             "cgroup_load": True,
             "type_load": True,
@@ -402,19 +2067,31 @@ class Ananicy:
             "apply_ionice": True,
             "apply_sched": True,
             "apply_oom_score_adj": True,
-            "apply_cgroup": True
+            "apply_cgroup": True,
+            "apply_affinity": True,
+            "apply_stats": True
         }
 
         self.load_config()
+        if rules_cache is not None:
+            self.rules_cache = rules_cache
         if daemon:
             self.__check_disks_schedulers()
         else:
             for i in self.verbose:
                 self.verbose[i] = False
 
+        self.backend = get_backend(self.backend_name)
+        self.config_stat = self.config_files_stat()
         self.load_cgroups()
-        self.load_types()
-        self.load_rules()
+        # Rules cache on disk matches loaded rules
+        self.rules_cache_valid = self.load_rules_cache()
+        if not self.rules_cache_valid:
+            self.load_types()
+            self.load_rules()
+            self.rules_cache_valid = self.save_rules_cache()
+        if not simulate:
+            self.placement.load_cpusets(self.rules, self.cgroup_fs)
         if os.getenv("NOTIFY_SOCKET"):
             subprocess.run(["systemd-notify", "--ready"])
 
@@ -454,6 +2131,64 @@ class Ananicy:
                 raise Failure("OOM_SCORE_ADJ must be in range -1000..1000")
         return adj
 
+    def __check_cpus(self, cpus):
+        if cpus is not None:
+            if not isinstance(cpus, str):
+                raise Failure('"cpus" must be cpulist, "nodeN", '
+                              '"smt-siblings-off" or "all"')
+            self.topology.resolve(cpus)
+        return cpus
+
+    def __check_numa(self, numa):
+        """ Node number or "nodeN", kept as "nodeN"
+        """
+        if numa is None:
+            return None
+        if isinstance(numa, int) and not isinstance(numa, bool):
+            numa = "node{}".format(numa)
+        nodes = self.topology.nodes
+        if not isinstance(numa, str) or not numa.startswith("node") or \
+                not numa[4:].isdecimal() or int(numa[4:]) not in nodes:
+            raise Failure("NUMA node must be one of: {}".format(
+                ", ".join(map(str, sorted(nodes)))))
+        return numa
+
+    def __check_placement(self, rule):
+        """ "cpus" must lie on "numa" node, task in node cpuset can't
+        get affinity outside of it; v2 process has one cgroup only
+        """
+        cpus, numa = rule["cpus"], rule["numa"]
+        if not numa:
+            return
+        if cpus and not self.topology.resolve(cpus) <= \
+                self.topology.resolve(numa):
+            raise Failure('"cpus" {} not on "numa" {}'.format(cpus, numa))
+        if rule["cgroup"] and os.path.exists(self.cgroup_fs +
+                                             "cgroup.controllers"):
+            raise Failure('"numa" and "cgroup" can\'t be combined on '
+                          'cgroup v2')
+
+    def __check_io_weight(self, weight):
+        if weight:
+            if not 1 <= weight <= 10000:
+                raise Failure("IOWeight must be in range 1..10000")
+        return weight
+
+    def __check_memory_high(self, size):
+        # bytes, or with K/M/G/T suffix like systemd
+        if not size:
+            return size
+        if str(size) == "max":
+            return "max"
+        units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+        size = str(size)
+        try:
+            if size[-1].upper() in units:
+                return int(size[:-1]) * units[size[-1].upper()]
+            return int(size)
+        except ValueError:
+            raise Failure("MemoryHigh must be bytes with optional K/M/G/T")
+
     def __check_disks_schedulers(self):
         prefix = "/sys/class/block/"
         for disk in os.listdir(prefix):
@@ -492,6 +2227,32 @@ class Ananicy:
                     if "check_freq=" in col:
                         check_freq = self.__get_val(col)
                         self.check_freq = float(check_freq)
+                    if "check_freq_min=" in col:
+                        self.check_freq_min = float(self.__get_val(col))
+                    if "tick_budget=" in col:
+                        self.tick_budget = float(self.__get_val(col))
+                    if "autogroup=" in col:
+                        self.autogroup_mode = self.__YN(self.__get_val(col))
+                    if "pressure_freq=" in col:
+                        self.pressure_freq = float(self.__get_val(col))
+                    if "control=" in col:
+                        self.control_path = self.__get_val(col)
+                    if "journal=" in col:
+                        self.journal_path = self.__get_val(col)
+                    if "apply_workers=" in col:
+                        self.apply_workers = int(self.__get_val(col))
+                    if "apply_queue=" in col:
+                        self.apply_queue = int(self.__get_val(col))
+                    if "proc_events=" in col:
+                        self.proc_events = self.__YN(self.__get_val(col))
+                    if "reconcile_freq=" in col:
+                        self.reconcile_freq = float(self.__get_val(col))
+                    if "metrics=" in col:
+                        self.metrics_listen = self.__get_val(col)
+                    if "rules_cache=" in col:
+                        self.rules_cache = self.__get_val(col)
+                    if "backend=" in col:
+                        self.backend_name = self.__get_val(col)
                     if "cgroup_load=" in col:
                         self.verbose["cgroup_load"] = self.__YN(
                             self.__get_val(col))
@@ -519,12 +2280,18 @@ class Ananicy:
                     if "apply_cgroup=" in col:
                         self.verbose["apply_cgroup"] = self.__YN(
                             self.__get_val(col))
+                    if "apply_affinity=" in col:
+                        self.verbose["apply_affinity"] = self.__YN(
+                            self.__get_val(col))
+                    if "apply_stats=" in col:
+                        self.verbose["apply_stats"] = self.__YN(
+                            self.__get_val(col))
                     if "check_disks_schedulers" in col:
                         self.verbose["check_disks_schedulers"] = self.__YN(
                             self.__get_val(col))
 
     def load_cgroups(self):
-        files = self.find_files(self.config_dir, '.*\\.cgroups')
+        files = self.config_files(".cgroups")
         for file in files:
             if self.verbose["cgroup_load"]:
                 print("Load cgroup:", file)
@@ -555,7 +2322,43 @@ class Ananicy:
         if not cpuquota:
             raise Failure('Missing "CPUQuota": ')
 
-        self.cgroups[cgroup] = CgroupController(cgroup, cpuquota)
+        factory = SimulatedCgroup if self.simulate else cgroup_controller
+        controller = factory(
+            cgroup, cpuquota,
+            io_weight=self.__check_io_weight(line.get("IOWeight")),
+            memory_high=self.__check_memory_high(line.get("MemoryHigh")),
+            threaded=bool(line.get("Threaded")),
+            track_tasks=bool(line.get("TrackTasks")),
+            cgroup_fs=self.cgroup_fs)
+        controller.adaptive = self.__check_adaptive(line, cpuquota,
+                                                    controller)
+        self.cgroups[cgroup] = controller
+
+    def __check_adaptive(self, line, cpuquota, controller):
+        """ CPUQuotaMin/CPUQuotaMax make quota follow pressure
+        """
+        low = line.get("CPUQuotaMin")
+        high = line.get("CPUQuotaMax")
+        if low is None and high is None:
+            return None
+        low = cpuquota if low is None else low
+        high = cpuquota if high is None else high
+        if not 0 < low <= cpuquota <= high:
+            raise Failure('Need 0 < "CPUQuotaMin" <= "CPUQuota" <= "CPUQuotaMax"')
+        resource = line.get("Pressure", "cpu")
+        if resource not in PressureMonitor.RESOURCES:
+            raise Failure('"Pressure" must be one of: {}'.format(
+                ", ".join(PressureMonitor.RESOURCES)))
+        target = line.get("PressureTarget", 10)
+        if not 0 <= target < 100:
+            raise Failure('"PressureTarget" must be in range 0..99')
+        interactive = line.get("PressureCgroup")
+        if interactive is not None:
+            if not isinstance(controller, (CgroupV2Controller,
+                                           SimulatedCgroup)):
+                raise Failure('"PressureCgroup" needs cgroup v2')
+            interactive = str(interactive).strip('/')
+        return (low, high, resource, target, interactive)
 
     def get_type_info(self, line):
         line = self.__strip_line(line)
@@ -567,7 +2370,7 @@ class Ananicy:
         if not _type:
             raise Failure('Missing "type": ')
 
-        self.types[_type] = {
+        type_info = {
             "nice": self.__check_nice(line.get("nice")),
             "ioclass": line.get("ioclass"),
             "ionice": self.__check_ionice(line.get("ionice")),
@@ -575,11 +2378,15 @@ class Ananicy:
             "rtprio": self.__check_rtprio(line.get("rtprio")),
             "oom_score_adj": self.__check_oom_score_adj(
                 line.get("oom_score_adj")),
-            "cgroup": line.get("cgroup")
+            "cgroup": line.get("cgroup"),
+            "cpus": self.__check_cpus(line.get("cpus")),
+            "numa": self.__check_numa(line.get("numa"))
         }
+        self.__check_placement(type_info)
+        self.types[_type] = type_info
 
     def load_types(self):
-        type_files = self.find_files(self.config_dir, '.*\\.types')
+        type_files = self.config_files(".types")
         for file in type_files:
             if self.verbose["type_load"]:
                 print("Load types:", file)
@@ -596,7 +2403,9 @@ class Ananicy:
                             file, line_number, e)
                         print(out, flush=True)
 
-    def get_rule_info(self, line):
+    def get_rule_info(self, line, rules=None):
+        if rules is None:
+            rules = self.rules
         line = self.__strip_line(line)
         if len(line) < 2:
             return
@@ -612,7 +2421,7 @@ class Ananicy:
                 raise Failure('"type": "{}" not defined'.format(_type))
             _type = self.types[_type]
             for attr in ("nice", "ioclass", "ionice", "sched", "rtprio",
-                         "oom_score_adj", "cgroup"):
+                         "oom_score_adj", "cgroup", "cpus", "numa"):
                 tmp = _type.get(attr)
                 if not tmp:
                     continue
@@ -630,10 +2439,13 @@ class Ananicy:
         cmdlines = line.get("cmdlines")
         if cmdlines:
             cmdlines = frozenset(cmdlines)
+            for cmdline in cmdlines:
+                if is_cmdline_pattern(cmdline):
+                    compile_cmdline_pattern(cmdline)
 
         key = (name, cmdlines)
 
-        self.rules[key] = {
+        rule = {
             "nice": self.__check_nice(line.get("nice")),
             "ioclass": line.get("ioclass"),
             "ionice": self.__check_ionice(line.get("ionice")),
@@ -642,18 +2454,31 @@ class Ananicy:
             "oom_score_adj": self.__check_oom_score_adj(
                 line.get("oom_score_adj")),
             "type": line.get("type"),
-            "cgroup": cgroup
+            "cgroup": cgroup,
+            "cpus": self.__check_cpus(line.get("cpus")),
+            "numa": self.__check_numa(line.get("numa"))
         }
+        self.__check_placement(rule)
+        rules[key] = rule
 
     def load_rules(self):
-        rule_files = self.find_files(self.config_dir, '.*\\.rules')
-        for file in rule_files:
+        """ Parse only files changed since last load, then swap
+        merged rules and index at once
+        """
+        rule_files = {}
+        for file in self.config_files(".rules"):
+            stat = self.config_stat[file]
+            cached = self.rule_files.get(file)
+            if cached and cached["stat"] == stat:
+                rule_files[file] = cached
+                continue
             if self.verbose["rule_load"]:
                 print("Load rules:", file)
+            file_rules = {}
             with open(file) as _rules_file:
                 for line_number, line in enumerate(_rules_file, start=1):
                     try:
-                        self.get_rule_info(line)
+                        self.get_rule_info(line, file_rules)
                     except Failure as e:
                         out = "File: {}, Line: {}, Error: {}".format(
                             file, line_number, e)
@@ -662,173 +2487,1404 @@ class Ananicy:
                         out = "File: {}, Line: {}, Error: {}".format(
                             file, line_number, e)
                         print(out, flush=True)
+            rule_files[file] = {"stat": stat, "rules": file_rules}
+
+        self.set_rule_files(rule_files)
+
+    def set_rule_files(self, rule_files):
+        # Later files override rules of earlier ones
+        rules = {}
+        for file in rule_files:
+            rules.update(rule_files[file]["rules"])
 
-        if not self.rules:
+        if not rules:
             raise Failure("No rules loaded")
 
+        self.rule_files = rule_files
+        self.rules = rules
+        self.build_rule_index()
+
+    def build_rule_index(self):
+        # name -> [(cmdlines, key, exact args, patterns), ...],
+        # most specific cmdlines first, so lookup cost does not
+        # depend on the total number of rules
+        index = {}
+        name_patterns = {}
+        for key in self.rules:
+            name, cmdlines = key
+            exact = patterns = frozenset()
+            if cmdlines:
+                patterns = frozenset(filter(is_cmdline_pattern, cmdlines))
+                exact = cmdlines - patterns
+                name_patterns.setdefault(name, set()).update(patterns)
+            index.setdefault(name, []).append((cmdlines, key, exact, patterns))
+        for candidates in index.values():
+            candidates.sort(key=lambda c: len(c[0] or ()), reverse=True)
+        # Raises Failure before anything is replaced
+        self.cmdline_matchers = {
+            name: CmdlineMatcher(patterns)
+            for name, patterns in name_patterns.items()
+        }
+        self.rule_index = index
+
+    def config_files_stat(self):
+        stat = {}
+        for file in self.find_files(self.config_dir,
+                                    '.*\\.(cgroups|types|rules)$'):
+            file_stat = os.stat(file)
+            stat[file] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return stat
+
+    def config_files(self, ext, config_stat=None):
+        if config_stat is None:
+            config_stat = self.config_stat
+        return [file for file in config_stat if file.endswith(ext)]
+
+    def config_signature(self, ext, config_stat=None):
+        if config_stat is None:
+            config_stat = self.config_stat
+        return tuple((file, config_stat[file])
+                     for file in self.config_files(ext, config_stat))
+
+    def rules_cache_signature(self):
+        """ Everything parsed types/rules depend on: files with
+        mtime and size, cgroups which were created and CPUs/NUMA
+        nodes "cpus"/"numa" were checked against
+        """
+        topology = (tuple(sorted(self.topology.online)),
+                    tuple((node, tuple(sorted(cpus))) for node, cpus in
+                          sorted(self.topology.nodes.items())))
+        return (self.RULES_CACHE_VERSION, self.config_signature(".types"),
+                self.config_signature(".rules"), tuple(sorted(self.cgroups)),
+                topology)
+
+    def load_rules_cache(self):
+        if not self.rules_cache:
+            return False
+        try:
+            with open(self.rules_cache, 'rb') as _cache_file:
+                cache = marshal.loads(_cache_file.read())
+            if cache["signature"] != self.rules_cache_signature():
+                return False
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return False
+        if self.verbose["rule_load"]:
+            print("Load rules cache:", self.rules_cache)
+        self.types = cache["types"]
+        self.set_rule_files(cache["rule_files"])
+        return True
+
+    def save_rules_cache(self):
+        """ Return True if cache was written
+        """
+        if not self.rules_cache:
+            return False
+        cache = {
+            "signature": self.rules_cache_signature(),
+            "types": self.types,
+            "rule_files": self.rule_files
+        }
+        tmp = self.rules_cache + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.rules_cache), mode=0o700,
+                        exist_ok=True)
+            with open(tmp, 'wb') as _cache_file:
+                marshal.dump(cache, _cache_file)
+            os.replace(tmp, self.rules_cache)
+        except OSError as e:
+            print("Can't write rules cache: {}".format(e), flush=True)
+            return False
+        return True
+
+    def __changed_rule_names(self, old_index, old_rules):
+        changed = set()
+        for name in old_index.keys() | self.rule_index.keys():
+            old = [(c[0], old_rules[c[1]]) for c in old_index.get(name, ())]
+            new = [(c[0], self.rules[c[1]])
+                   for c in self.rule_index.get(name, ())]
+            if old != new:
+                changed.add(name)
+        return changed
+
+    def reload_config(self):
+        """ Re-parse changed config files, keep proc map and
+        re-apply only processes whose matched rules changed
+        """
+        saved = (self.config_stat, self.cgroups, self.types, self.rule_files,
+                 self.rules, self.rule_index)
+        old_stat, old_cgroups, _, _, old_rules, old_index = saved
+        try:
+            self.config_stat = self.config_files_stat()
+            if (self.config_signature(".cgroups") !=
+                    self.config_signature(".cgroups", old_stat)):
+                self.__flush_cgroups()
+                self.cgroups = {}
+                self.load_cgroups()
+            if (self.config_signature(".types") !=
+                    self.config_signature(".types", old_stat) or
+                    self.cgroups.keys() != old_cgroups.keys()):
+                # Every rule may depend on types and cgroups
+                self.types = {}
+                self.load_types()
+                self.rule_files = {}
+            self.load_rules()
+        except (Failure, OSError) as e:
+            (self.config_stat, self.cgroups, self.types, self.rule_files,
+             self.rules, self.rule_index) = saved
+            print("Reload failed, keep old config: {}".format(e), flush=True)
+            return
+        self.rules_cache_valid = self.save_rules_cache()
+        self.placement.load_cpusets(self.rules, self.cgroup_fs)
+
+        changed = self.__changed_rule_names(old_index, old_rules)
+        affected = set()
+        for pid, entry in list(self.rule_cache.items()):
+            if not changed.isdisjoint(entry["rules"]):
+                del self.rule_cache[pid]
+                affected.add(pid)
+        reapplied = 0
+        for pid, tpid in list(self.proc):
+            if pid not in affected:
+                continue
+            tpid = TPID(pid, tpid, verbose_opts=self.verbose,
+                        backend=self.backend, proc_fs=self.proc_fs)
+            self.retries.discard(tpid.key)
+            self.__process_isolated(tpid)
+            reapplied += 1
+        self.__flush_cgroups()
+        print("Reload: {} rule name(s) changed, {} thread(s) re-applied".format(
+            len(changed), reapplied), flush=True)
+
     def dir_must_exits(self, path):
         if not os.path.exists(path):
             raise Failure("Missing dir: " + path)
 
     def find_files(self, path, name_mask):
         files = []
-        entries = sorted(os.listdir(path))
-        if not entries:
-            return files
-        for entry_name in entries:
-            entry_path = path + "/" + entry_name
-            if os.path.isdir(entry_path):
-                files += self.find_files(entry_path, name_mask)
-            if os.path.isfile(entry_path):
-                if re.search(name_mask, entry_name):
-                    realpath = os.path.realpath(entry_path)
-                    files.append(realpath)
+        name_re = re.compile(name_mask)
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir():
+                files += self.find_files(entry.path, name_mask)
+            elif entry.is_file() and name_re.search(entry.name):
+                # Only symlinks need resolving
+                if entry.is_symlink():
+                    files.append(os.path.realpath(entry.path))
+                else:
+                    files.append(os.path.abspath(entry.path))
         return files
 
-    def __proc_tpids(self):
-        decimal_pids = filter(str.isdecimal, os.listdir("/proc"))
-        for pid in filter(is_simple_proc_pid, decimal_pids):
-            tasks_path = "/proc/{}/task/".format(pid)
-            for tpid in filter(str.isdecimal, os.listdir(tasks_path)):
-                yield TPID(int(pid), int(tpid), verbose_opts=self.verbose)
+    def forget_proc(self):
+        """ Drop everything known about running tasks
+        """
+        self.proc = {}
+        self.proc_ids = {}
+        self.rule_cache = {}
+
+    def __proc_processes(self):
+        """ Yield (pid, identity, [tpid, ...]) for every process in system
+        """
+        proc_fd = os.open(self.proc_fs, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with os.scandir(proc_fd) as entries:
+                for entry in entries:
+                    if not entry.name.isdecimal():
+                        continue
+                    try:
+                        task_fd = os.open(entry.name + "/task",
+                                          os.O_RDONLY | os.O_DIRECTORY,
+                                          dir_fd=proc_fd)
+                    except FileNotFoundError:
+                        continue
+                    try:
+                        tasks = os.listdir(task_fd)
+                    finally:
+                        os.close(task_fd)
+                    exe = read_exe(entry.name, dir_fd=proc_fd,
+                                   proc_fs=self.proc_fs)
+                    try:
+                        identity = read_identity(entry.name, exe,
+                                                 dir_fd=proc_fd)
+                    except (OSError, ValueError, IndexError):
+                        # Exited while scanned
+                        continue
+                    yield int(entry.name), identity, [int(tpid)
+                                                      for tpid in tasks]
+        finally:
+            os.close(proc_fd)
+
+    def __forget_task(self, pid, tpid):
+        self.retries.discard((pid, tpid))
+        if self.journal:
+            self.journal.forget((pid, tpid))
+        for cgroup in self.cgroups.values():
+            cgroup.forget_task(pid, tpid)
 
     def proc_map_update(self):
+        start = time.perf_counter()
+        self.scan_gen += 1
         proc_found = set()
+        proc_ids = {}
         new_tpids = []
-        for tpid in self.__proc_tpids():
-            key = (tpid.pid, tpid.tpid, tpid.cmd)
-            proc_found.add(key)
-            if key in self.proc:
-                continue
-            else:
-                new_tpid = tpid
-                self.proc[key] = new_tpid
-                new_tpids.append(new_tpid)
-        exited_proc = set(self.proc.keys()) - proc_found
+        for pid, identity, tpids in self.__proc_processes():
+            proc_ids[pid] = identity
+            old_identity = self.proc_ids.get(pid)
+            # pid reused or exec done: match all threads again
+            changed = old_identity is not None and old_identity != identity
+            for tpid in tpids:
+                key = (pid, tpid)
+                proc_found.add(key)
+                if key in self.proc:
+                    if not changed:
+                        continue
+                    self.__forget_task(pid, tpid)
+                self.proc[key] = 0
+                new_tpids.append(TPID(pid, tpid, verbose_opts=self.verbose,
+                                      backend=self.backend, exe=identity[1],
+                                      proc_fs=self.proc_fs))
+        exited_proc = self.proc.keys() - proc_found
         # Remove exited from map
         for proc_key in exited_proc:
             del self.proc[proc_key]
+            self.__forget_task(*proc_key)
+        self.proc_ids = proc_ids
+        for pid in self.rule_cache.keys() - proc_ids.keys():
+            del self.rule_cache[pid]
+        self.metrics.observe("ananicy_scan_duration_seconds",
+                             time.perf_counter() - start)
+        self.metrics.inc("ananicy_threads_scanned_total", len(proc_found))
+        self.metrics.inc("ananicy_new_tasks_total", len(new_tpids))
+        self.metrics.set("ananicy_scan_new_tasks", len(new_tpids))
+        self.metrics.set("ananicy_proc_map_size", len(self.proc))
+        return new_tpids
+
+    def proc_events_update(self, events):
+        """ Same as proc_map_update, but only for tasks from proc events
+        """
+        self.scan_gen += 1
+        changed = {}
+        for event, pid, tpid in events:
+            if event == ProcConnector.EXIT:
+                changed.pop((pid, tpid), None)
+                self.proc.pop((pid, tpid), None)
+                self.__forget_task(pid, tpid)
+                if pid == tpid:
+                    self.rule_cache.pop(pid, None)
+                    self.proc_ids.pop(pid, None)
+            else:
+                # exec/comm change what thread matches
+                if changed.get((pid, tpid)) in (None, ProcConnector.FORK):
+                    changed[(pid, tpid)] = event
+                if event in (ProcConnector.EXEC, ProcConnector.COMM):
+                    self.rule_cache.pop(pid, None)
+                    self.proc_ids.pop(pid, None)
+
+        new_tpids = []
+        for (pid, tpid), event in changed.items():
+            if event == ProcConnector.FORK and (pid, tpid) in self.proc:
+                continue
+            if event != ProcConnector.FORK:
+                self.__forget_task(pid, tpid)
+            tpid = TPID(pid, tpid, verbose_opts=self.verbose,
+                        backend=self.backend, proc_fs=self.proc_fs)
+            if pid not in self.proc_ids:
+                try:
+                    self.proc_ids[pid] = read_identity(
+                        pid, tpid.exe, proc_fs=self.proc_fs)
+                except (OSError, ValueError, IndexError):
+                    continue
+            self.proc[tpid.key] = 0
+            new_tpids.append(tpid)
+        self.metrics.inc("ananicy_new_tasks_total", len(new_tpids))
+        self.metrics.set("ananicy_proc_map_size", len(self.proc))
         return new_tpids
 
+    def match_rule(self, names, get_cmdline):
+        """ Return key of first matching rule
+        """
+        rule_cmdline = None
+        for rule_name in names:
+            matching = None
+            for cmdlines, key, exact, patterns in self.rule_index.get(
+                    rule_name, ()):
+                if cmdlines:
+                    # cmdline is read only if some candidate needs it
+                    if rule_cmdline is None:
+                        rule_cmdline = get_cmdline()
+                    if not exact.issubset(rule_cmdline):
+                        continue
+                    if patterns:
+                        # All patterns of this name checked in one go
+                        if matching is None:
+                            matching = self.cmdline_matchers[
+                                rule_name].matching(rule_cmdline)
+                        if not patterns.issubset(matching):
+                            continue
+                return key
+
+    def __tpid_names(self, tpid: TPID):
+        yield tpid.cmd
+        yield tpid.stat_name
+
+    def __rule_cache_entry(self, tpid: TPID):
+        entry = self.rule_cache.get(tpid.pid)
+        if entry and entry["gen"] == self.scan_gen:
+            return entry
+        # Recheck once per scan that pid still belongs to same process
+        key = self.proc_ids.get(tpid.pid)
+        if key is None:
+            key = read_identity(tpid.pid, tpid.exe, proc_fs=self.proc_fs)
+        if not entry or entry["key"] != key:
+            entry = {"key": key, "cmdline": None, "rules": {}, "applied": {}}
+            self.rule_cache[tpid.pid] = entry
+        entry["gen"] = self.scan_gen
+        return entry
+
     def get_tpid_rule(self, tpid: TPID):
-        rule_cmdlines = tpid.cmdline
-        for rule_name in [tpid.cmd, tpid.stat_name]:
-            for key in self.rules:
-                name,cmdlines = key
-                if name == rule_name:
-                    if cmdlines:
-                        for cl in cmdlines:
-                            if cl not in rule_cmdlines:
-                                break
-                        else:
-                            return self.rules[key]
-                    else:
-                        return self.rules[key]
+        key = self.get_tpid_rule_key(tpid)
+        if key:
+            return self.rules[key]
+
+    def get_tpid_rule_key(self, tpid: TPID):
+        entry = self.__rule_cache_entry(tpid)
+
+        def get_cmdline():
+            if entry["cmdline"] is None:
+                entry["cmdline"] = tpid.cmdline
+            return entry["cmdline"]
+
+        rules = entry["rules"]
+        for rule_name in self.__tpid_names(tpid):
+            if rule_name not in rules:
+                rules[rule_name] = self.match_rule((rule_name,), get_cmdline)
+            if rules[rule_name]:
+                return rules[rule_name]
 
     def process_tpid(self, tpid):
         if not tpid.exists():
             return
-        rule = self.get_tpid_rule(tpid)
-        if not rule:
+        key = self.get_tpid_rule_key(tpid)
+        if not key:
+            return
+        self.metrics.inc("ananicy_rule_hits_total", rule=format_rule_key(key))
+        job = (tpid, key, self.rules[key],
+               self.rule_cache[tpid.pid]["applied"], {})
+        if self.apply_pool is not None:
+            self.apply_pool.submit(tpid.pid, job)
             return
-        tpid.apply_rules(rule, self.cgroups)
+        try:
+            counts = self.apply_tpid(*job)
+        finally:
+            self.__observe_timings(job[4])
+        self.__account_applied(tpid, key, counts)
+
+    def apply_tpid(self, tpid, key, rule, applied, timings):
+        """ Apply matched rule, runs in apply workers
+        """
+        return tpid.apply_rules(rule, self.cgroups, applied, timings,
+                                self.placement, self.autogroups)
+
+    def __observe_timings(self, timings):
+        for attr, seconds in timings.items():
+            self.metrics.observe("ananicy_apply_duration_seconds",
+                                 seconds, attr=attr)
+
+    def __account_applied(self, tpid, key, counts):
+        self.apply_stats["threads"] += 1
+        self.apply_stats["avoided"] += counts["avoided"]
+        self.apply_stats["rules"].add(key)
+        rule_stats = self.rule_stats.setdefault(
+            key, {"applied": 0, "skipped": 0, "avoided": 0})
+        for count in counts:
+            rule_stats[count] += counts[count]
+        if tpid.key in self.proc:
+            self.proc[tpid.key] = tpid.state.value
         if tpid.state != TPID.State.ALLSET:
             print("Warn: Not all rules were applied on {}[{}/{}] = {}".format(tpid.cmd, tpid.pid, tpid.tpid, tpid.state))
+            self.__retry(tpid)
+            return
+        self.retries.discard(tpid.key)
+        if self.journal and tpid.pid in self.proc_ids:
+            self.journal.record(tpid.pid, tpid.tpid,
+                                self.proc_ids[tpid.pid][0],
+                                rule_hash(self.rules[key]), tpid.state.value)
+
+    def __retry(self, tpid):
+        if tpid.key not in self.proc:
+            return
+        if not self.retries.add(tpid):
+            self.metrics.inc("ananicy_retry_giveups_total")
+            print("Warn: Give up on {}[{}/{}] after {} attempts".format(
+                tpid.cmd, tpid.pid, tpid.tpid, RetryQueue.MAX_ATTEMPTS))
+        self.metrics.set("ananicy_retry_queue_length", len(self.retries))
+
+    def __process_isolated(self, tpid):
+        """ process_tpid, errors only affect this thread
+        """
+        try:
+            self.process_tpid(tpid)
+        except Exception as exc:
+            self.__report_error(exc, tpid)
+            self.__retry(tpid)
 
-    def run(self):
-        while True:
-            try:
-                # proc_map_update returns only new found processes
-                for tpid in self.proc_map_update():
-                        self.process_tpid(tpid)
-            except Exception as exc:
-                print("Error: {}".format(exc))
-            sleep(self.check_freq)
+    def __collect_applied(self):
+        """ Account jobs finished by apply workers
+        """
+        if self.apply_pool is None:
+            return
+        finished = 0
+        for (tpid, key, _, _, timings), counts, exc in \
+                self.apply_pool.results():
+            finished += 1
+            self.__observe_timings(timings)
+            if exc is not None:
+                self.__report_error(exc, tpid)
+                self.__retry(tpid)
+                continue
+            self.__account_applied(tpid, key, counts)
+        self.metrics.set("ananicy_apply_queue_length", len(self.apply_pool))
+        self.metrics.set("ananicy_apply_backpressure_seconds_total",
+                         self.apply_pool.blocked)
+        if finished:
+            self.__flush_cgroups()
+            self.__report_apply_stats()
+            self.__flush_journal()
+
+    def __report_error(self, exc, tpid=None):
+        self.metrics.inc("ananicy_failures_total")
+        if tpid is None:
+            print("Error: {}".format(exc))
+        else:
+            print("Error: {}[{}/{}]: {}".format(tpid.cmd, tpid.pid, tpid.tpid,
+                                                exc))
+
+    def __flush_cgroups(self):
+        for cgroup in self.cgroups.values():
+            failed = cgroup.flush()
+            if failed:
+                self.__cgroup_failed(cgroup, failed)
+
+    def __cgroup_failed(self, cgroup, pids):
+        """ CGROUP is set once task is queued for flush(), take it
+        back from tasks which were not moved and retry them
+        """
+        print("Warn: {} task(s) not moved to cgroup {}".format(
+            len(pids), cgroup.name), flush=True)
+        pids = set(pids)
+        # Process scope cgroups move all threads of pid
+        index = 0 if cgroup.PROCESS_SCOPE else 1
+        self.__unset_applied([key for key in self.proc
+                              if key[index] in pids], TPID.State.CGROUP)
+
+    def __unset_applied(self, keys, flag):
+        """ Clear flag of threads which had it set and retry them
+        """
+        for key in keys:
+            state = self.proc.get(key)
+            if state is None or not state & flag.value:
+                continue
+            state &= ~flag.value
+            self.proc[key] = state
+            entry = self.rule_cache.get(key[0])
+            if entry:
+                entry["applied"].pop(flag, None)
+            if self.journal and key in self.journal.applied and \
+                    key[0] in self.proc_ids:
+                # Later record wins, restart won't skip this thread
+                self.journal.record(*key, self.proc_ids[key[0]][0],
+                                    self.journal.applied[key], state)
+                self.journal.forget(key)
+            tpid = TPID(*key, verbose_opts=self.verbose,
+                        backend=self.backend, proc_fs=self.proc_fs)
+            tpid.reset_state(state)
+            self.__retry(tpid)
+
+    def __report_apply_stats(self):
+        if self.apply_stats["threads"]:
+            msg = "Apply: {} thread(s), {} process wide operation(s) avoided".format(
+                self.apply_stats["threads"], self.apply_stats["avoided"])
+            print_verbose_msg(msg, self.verbose, "apply_stats")
+            for key in self.apply_stats["rules"]:
+                msg = "Apply: rule {}: applied {applied}, skipped {skipped}, avoided {avoided}".format(
+                    format_rule_key(key), **self.rule_stats[key])
+                print_verbose_msg(msg, self.verbose, "apply_stats")
+        self.apply_stats = {"threads": 0, "avoided": 0, "rules": set()}
+
+    def __open_proc_connector(self):
+        if not self.proc_events:
+            return None
+        try:
+            return ProcConnector()
+        except OSError as e:
+            print("Proc connector unavailable ({}), use periodic scan".format(e),
+                  flush=True)
+            return None
 
-    def dump_types(self):
-        print(json.dumps(self.types, indent=4), flush=True)
+    def __request_reload(self, signum, frame):
+        self.reload_pending = True
 
-    def dump_cgroups(self):
-        cgroups_dict = {
-            cgroup: self.cgroups[cgroup].__dict__ for cgroup in self.cgroups
-        }
-        print(json.dumps(cgroups_dict, indent=4), flush=True)
+    def __open_metrics_server(self):
+        if not self.metrics_listen:
+            return None
+        try:
+            return MetricsServer(self.metrics_listen)
+        except OSError as e:
+            print("Metrics endpoint {} unavailable: {}".format(
+                self.metrics_listen, e), flush=True)
+            return None
+
+    def __open_control_server(self):
+        if not self.control_path:
+            return None
+        try:
+            return ControlServer(self.control_path)
+        except OSError as e:
+            print("Control socket {} unavailable: {}".format(
+                self.control_path, e), flush=True)
+            return None
 
-    def dump_rules(self):
-        pprint.pp(self.rules)
+    def __open_autogroups(self):
+        """ Autogroup mode needs autogroups, service start disables them
+        """
+        if not self.autogroup_mode:
+            return None
+        try:
+            with open(AutogroupIndex.SYSCTL, 'w') as _sysctl:
+                _sysctl.write("1")
+        except OSError as e:
+            print("Can't enable autogroups ({}), set nice per thread".format(
+                e), flush=True)
+            return None
+        return AutogroupIndex()
 
-    def dump_proc(self):
-        self.proc_map_update()
-        proc_dict = {}
-        for tpid in self.proc:
+    def __update_autogroups(self):
+        """ After full scan: find autogroups rules may own, release
+        claimed ones which got other processes or lost matched ones
+        """
+        if self.autogroups is None:
+            return
+        index = self.autogroup_index()
+        eligible = {}
+        for group, info in index.items():
+            nice = self.__group_rule_nice(info["pids"])
+            if nice is not None:
+                eligible[group] = nice
+        released = set(self.autogroups.update(index, eligible, self.proc_fs))
+        if released:
+            # Their nice now has to be set per thread
+            self.__unset_applied([key for key in self.proc
+                                  if key[0] in released], TPID.State.NICE)
+
+    def __group_rule_nice(self, pids):
+        """ Nice rules give to every one of pids, else None
+        """
+        wanted = None
+        for pid in pids:
+            tpid = TPID(pid, pid, verbose_opts=self.verbose,
+                        backend=self.backend, exe=self.proc_ids[pid][1],
+                        proc_fs=self.proc_fs)
             try:
-                TPID_l = self.proc[tpid]
-                proc_dict[tpid] = {
-                    "pid": TPID_l.pid,
-                    "tpid": TPID_l.tpid,
-                    "exe": TPID_l.exe,
-                    "cmd": TPID_l.cmd,
-                    "stat": TPID_l.stat,
-                    "stat_name": TPID_l.stat_name,
-                    "nice": TPID_l.nice,
-                    "autogroup": TPID_l.autogroup,
-                    "sched": TPID_l.sched,
-                    "rtprio": TPID_l.rtprio,
-                    "ionice": [TPID_l.ioclass, TPID_l.ionice],
-                    "oom_score_adj": TPID_l.oom_score_adj,
-                    "cmdline": TPID_l.cmdline,
-                }
-            except FileNotFoundError:
-                continue
+                key = self.get_tpid_rule_key(tpid)
+            except (OSError, ValueError, IndexError):
+                return None
+            nice = self.rules[key].get("nice") if key else None
+            if nice is None or wanted not in (None, nice):
+                return None
+            wanted = nice
+        return wanted
+
+    def __open_journal(self):
+        """ Return entries saved by previous daemon run, journal is
+        started empty: first scan writes back ones still valid, if
+        it fails they are just applied again
+        """
+        if not self.journal_path:
+            return {}
+        self.journal = StateJournal(self.journal_path)
+        entries = self.journal.load()
+        self.journal.rewrite({})
+        return entries
+
+    def __skip_journaled(self, tpids, journaled):
+        """ Drop threads previous run fully applied, if process
+        is same and its rule did not change since
+        """
+        kept = {}
+        todo = []
+        for tpid in tpids:
+            entry = journaled.get(tpid.key)
+            identity = self.proc_ids.get(tpid.pid)
+            if entry and identity and entry[0] == identity[0] and \
+                    entry[2] == TPID.State.ALLSET.value:
+                try:
+                    key = self.get_tpid_rule_key(tpid)
+                except OSError:
+                    key = None
+                if key and rule_hash(self.rules[key]) == entry[1]:
+                    self.proc[tpid.key] = entry[2]
+                    kept[tpid.key] = entry
+                    continue
+            todo.append(tpid)
+        self.journal.rewrite(kept)
+        print("Journal: {} thread(s) already applied, {} to process".format(
+            len(kept), len(todo)), flush=True)
+        return todo
+
+    def __flush_journal(self):
+        if not self.journal:
+            return
+        self.journal.flush()
+        if self.journal.stale():
+            self.journal.rewrite({
+                key: (self.proc_ids[key[0]][0], hash,
+                      TPID.State.ALLSET.value)
+                for key, hash in self.journal.applied.items()
+                if key[0] in self.proc_ids})
+
+    def __adaptive_cgroups(self):
+        adaptive = [cgroup for cgroup in self.cgroups.values()
+                    if cgroup.adaptive]
+        for cgroup in adaptive:
+            sources = cgroup.pressure_sources(
+                self.pressure.path(cgroup.adaptive[2]))
+            missing = [path for path in sources
+                       if path and not os.path.exists(path)]
+            if missing:
+                print("No {}, cgroup {} keeps CPUQuota {}".format(
+                    missing[0], cgroup.name, cgroup.cpuquota), flush=True)
+                cgroup.adaptive = None
+        return [cgroup for cgroup in adaptive if cgroup.adaptive]
+
+    def __adapt_cgroups(self):
+        """ Move adaptive cgroups quota one step towards pressure target
+        """
+        # path -> percent, each file read once per round
+        pressure = {}
 
-        pprint.pprint(proc_dict)
+        def read(path):
+            if path not in pressure:
+                pressure[path] = self.pressure.read(path)
+            return pressure[path]
 
-    def dump_autogroup(self):
-        self.proc_map_update()
-        proc_autogroup = {}
-        for tpid in self.proc:
+        for cgroup in self.__adaptive_cgroups():
+            resource = cgroup.adaptive[2]
             try:
-                TPID_l = self.proc[tpid]
-                group_num = TPID_l.autogroup["group"]
-                proc_autogroup[group_num] = {
-                    "nice": TPID_l.autogroup["nice"],
-                    "proc": {}
-                }
-            except FileNotFoundError:
+                system = self.pressure.path(resource)
+                measured, own = cgroup.pressure_sources(system)
+                if read(system) is not None:
+                    self.metrics.set("ananicy_pressure_percent",
+                                     pressure[system], resource=resource)
+                outside = read(measured)
+                if own is not None and outside is not None:
+                    stalled = read(own)
+                    # Own stalls overlap with outside ones, so this
+                    # is a lower bound of pressure outside cgroup
+                    outside = None if stalled is None else max(
+                        0.0, outside - stalled)
+                if outside is None:
+                    continue
+                if cgroup.adapt(outside):
+                    msg = "cgroup: {} CPUQuota -> {}% ({} pressure {:.1f}%)".format(
+                        cgroup.name, cgroup.cpuquota, resource, outside)
+                    print_verbose_msg(msg, self.verbose, "apply_cgroup")
+            except (OSError, ValueError, IndexError, Failure) as exc:
+                self.__report_error(exc)
+            self.metrics.set("ananicy_cgroup_quota_percent",
+                             cgroup.cpuquota, cgroup=cgroup.name)
+
+    def __likely_matched(self, tpid):
+        return tpid.cmd in self.rule_index
+
+    def __schedule(self, tpids):
+        self.scheduler.push(tpids, self.__likely_matched)
+        self.metrics.set("ananicy_queue_length", len(self.scheduler))
+
+    def __tick(self):
+        self.__schedule(self.retries.due())
+        latencies = self.scheduler.tick(self.__process_isolated)
+        for latency in latencies:
+            self.metrics.observe("ananicy_queue_latency_seconds", latency)
+        self.metrics.set("ananicy_queue_length", len(self.scheduler))
+        if self.apply_pool is not None:
+            self.__collect_applied()
+        elif latencies:
+            self.__flush_cgroups()
+            self.__report_apply_stats()
+        self.__flush_journal()
+
+    def __wait(self, connector, deadline):
+        """ Sleep till next full scan or scheduler tick, meanwhile
+        handle proc events, reload requests and metrics scrapes.
+        Return True if full scan is needed right now
+        """
+        fds = [self.__wakeup_r]
+        if connector:
+            fds.append(connector)
+        if self.__metrics_server:
+            fds.append(self.__metrics_server)
+        control = self.__control_server
+        if control:
+            fds.append(control)
+        while True:
+            if self.reload_pending:
+                self.reload_pending = False
+                self.reload_config()
+            if connector and connector.overrun:
+                connector.overrun = False
+                return True
+            now = time.monotonic()
+            wake = min((t for t in (self.scheduler.next_tick(deadline, now),
+                                    self.retries.next_due())
+                        if t is not None), default=None)
+            timeout = (deadline if wake is None else min(deadline, wake)) - now
+            if timeout <= 0:
+                return False
+            readers, writers = fds, []
+            if control and control.clients:
+                readers = fds + control.readers()
+                writers = control.writers()
+                timeout = min(timeout, ControlServer.TIMEOUT)
+            ready, writable, _ = select.select(readers, writers, [], timeout)
+            if self.__wakeup_r in ready:
+                os.read(self.__wakeup_r, 4096)
+                self.__collect_applied()
+            if self.__metrics_server in ready:
+                self.__metrics_server.handle(self.metrics.render)
+            if control and (ready or writable or control.clients):
+                control.handle(self.query, ready, writable)
+            if connector is None or connector not in ready:
                 continue
-
-        for tpid in self.proc:
             try:
-                TPID_l = self.proc[tpid]
-                group_num = TPID_l.autogroup["group"]
-                proc_autogroup[group_num]["proc"][tpid] = {
-                    "pid": TPID_l.pid,
-                    "tpid": TPID_l.tpid,
-                    "exe": TPID_l.exe,
-                    "cmd": TPID_l.cmd,
-                    "stat": TPID_l.stat,
-                    "stat_name": TPID_l.stat_name,
-                    "nice": TPID_l.nice,
-                    "sched": TPID_l.sched,
-                    "ionice": [TPID_l.ioclass, TPID_l.ionice],
-                    "oom_score_adj": TPID_l.oom_score_adj,
-                    "cmdline": TPID_l.cmdline,
-                }
-            except FileNotFoundError:
+                self.__schedule(
+                    self.proc_events_update(connector.read_events()))
+            except Exception as exc:
+                self.__report_error(exc)
+
+    def run(self):
+        connector = self.__open_proc_connector()
+        self.__metrics_server = self.__open_metrics_server()
+        self.__control_server = self.__open_control_server()
+        self.autogroups = self.__open_autogroups()
+        self.scheduler = TaskScheduler(self.tick_budget,
+                                       min(self.check_freq_min,
+                                           self.check_freq),
+                                       self.check_freq)
+        # SIGHUP - reload config, wakeup fd interrupts select()
+        self.__wakeup_r, wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGHUP, self.__request_reload)
+        if self.apply_workers > 0:
+            self.apply_pool = ApplyPool(self.apply_tpid, self.apply_workers,
+                                        self.apply_queue, wakeup_w)
+        journaled = self.__open_journal()
+        next_scan = time.monotonic()
+        next_adapt = math.inf
+        while True:
+            # Reload may add adaptive cgroups
+            if next_adapt == math.inf and self.__adaptive_cgroups():
+                next_adapt = time.monotonic()
+            if time.monotonic() >= next_adapt:
+                self.__adapt_cgroups()
+                next_adapt = time.monotonic() + self.pressure_freq
+            if time.monotonic() >= next_scan:
+                new_tpids = []
+                try:
+                    # proc_map_update returns only new found processes
+                    new_tpids = self.proc_map_update()
+                    self.__update_autogroups()
+                    if journaled is not None and self.journal:
+                        new_tpids = self.__skip_journaled(new_tpids,
+                                                          journaled)
+                except Exception as exc:
+                    self.__report_error(exc)
+                journaled = None
+                self.__schedule(new_tpids)
+                if connector:
+                    interval = self.reconcile_freq
+                else:
+                    interval = self.scheduler.scan_interval(len(new_tpids))
+                self.metrics.set("ananicy_scan_interval_seconds", interval)
+                next_scan = time.monotonic() + interval
+            self.__tick()
+            if self.__wait(connector, min(next_scan, next_adapt)):
+                next_scan = time.monotonic()
+
+    def query(self, what=None, *args):
+        """ Answer control socket query, yield JSON serializable objects
+        """
+        queries = {
+            "proc": self.query_proc,
+            "autogroup": self.query_autogroup,
+            "rules": self.query_rules,
+            "types": self.query_types,
+            "cgroups": self.query_cgroups,
+            "stats": self.query_stats,
+        }
+        if what not in queries:
+            raise Failure("Unknown query {}, expected one of: {}".format(
+                what, ", ".join(queries)))
+        try:
+            return queries[what](*[int(arg) for arg in args])
+        except (TypeError, ValueError) as e:
+            raise Failure("Bad query arguments: {}".format(e))
+
+    def query_proc(self, pid=None):
+        """ One line per process: identity, matched rules by name
+        and applied state of every thread
+        """
+        threads = {}
+        for (tpid_pid, tpid), state in list(self.proc.items()):
+            if pid is None or tpid_pid == pid:
+                threads.setdefault(tpid_pid, []).append((tpid, state))
+        for tpid_pid in sorted(threads):
+            start_time, exe, comm = self.proc_ids.get(tpid_pid,
+                                                      (None, None, None))
+            entry = self.rule_cache.get(tpid_pid)
+            rules = {}
+            if entry:
+                rules = {name: format_rule_key(key)
+                         for name, key in entry["rules"].items() if key}
+            yield {
+                "pid": tpid_pid,
+                "start_time": start_time,
+                "exe": exe,
+                "comm": comm,
+                "rules": rules,
+                "threads": [{"tid": tpid, "state": TPID.state_names(state)}
+                            for tpid, state in sorted(threads[tpid_pid])],
+            }
+
+    def autogroup_index(self):
+        """ Autogroup -> {"nice", "pids"}, single pass over processes
+        """
+        groups = {}
+        for pid in sorted(self.proc_ids):
+            autogroup = read_autogroup(pid, self.proc_fs)
+            if autogroup is None:
                 continue
+            group = groups.setdefault(autogroup["group"], {
+                "nice": autogroup["nice"], "pids": []})
+            group["pids"].append(pid)
+        return groups
+
+    def query_autogroup(self):
+        """ One line per autogroup with its processes and nice
+        given by rules in autogroup mode
+        """
+        groups = self.autogroup_index()
+        owners = self.autogroups.groups if self.autogroups else {}
+        for group in sorted(groups):
+            yield dict(group=group, rule_nice=owners.get(group),
+                       **groups[group])
+
+    def query_rules(self):
+        hits = {dict(labels).get("rule"): value for labels, value in
+                self.metrics.values["ananicy_rule_hits_total"].items()}
+        for key, rule in self.rules.items():
+            name, cmdlines = key
+            yield dict(
+                rule=format_rule_key(key), name=name,
+                cmdlines=sorted(cmdlines) if cmdlines else None,
+                hits=hits.get(format_rule_key(key), 0),
+                **rule, **self.rule_stats.get(key, {}))
+
+    def query_types(self):
+        for name, type in self.types.items():
+            yield dict(type=name, **type)
+
+    def query_cgroups(self):
+        for name, cgroup in self.cgroups.items():
+            info = {k: v for k, v in cgroup.__dict__.items()
+                    if k not in ("tasks", "pending")}
+            info["tasks"] = len(cgroup.tasks)
+            yield info
+
+    def query_stats(self):
+        yield {
+            "threads": len(self.proc),
+            "processes": len(self.proc_ids),
+            "scans": self.scan_gen,
+            "queue": len(self.scheduler) if self.scheduler else 0,
+            "apply_queue": len(self.apply_pool) if self.apply_pool else 0,
+            "retries": len(self.retries),
+            "journal": len(self.journal.applied) if self.journal else 0,
+        }
+
+    def dump(self, request):
+        """ Answer query without daemon: proc state comes from one
+        scan, rules are matched but nothing is applied
+        """
+        if request[0] in ("proc", "autogroup"):
+            for tpid in self.proc_map_update():
+                try:
+                    self.get_tpid_rule_key(tpid)
+                except OSError:
+                    continue
+        for obj in self.query(*request):
+            print(json.dumps(obj))
+        sys.stdout.flush()
+
+    def bench_rules(self, count=200000):
+        probes = []
+        for name, cmdlines in self.rules:
+            probes.append(((name,), tuple(cmdlines or ())))
+            probes.append(((name + "-miss",), ()))
+        lookups = 0
+        start = time.perf_counter()
+        while lookups < count:
+            for names, cmdline in probes:
+                self.match_rule(names, lambda: cmdline)
+            lookups += len(probes)
+        elapsed = time.perf_counter() - start
+        print("rules: {}, names: {}, lookups: {}, time: {:.3f}s, lookups/s: {:.0f}".format(
+            len(self.rules), len(self.rule_index), lookups, elapsed,
+            lookups / elapsed), flush=True)
+
+    def bench_apply(self, count=200):
+        # Re-apply the current nice/ioprio of this process, so the
+        # benchmark has no visible effect
+        pid = os.getpid()
+        nice = os.getpriority(os.PRIO_PROCESS, pid)
+        for backend in (SubprocessBackend(), get_backend(NativeBackend.NAME)):
+            ioclass, ionice = backend.get_ioprio(pid)
+            if ioclass == "none":
+                ioclass = "best-effort"
+            start = time.perf_counter()
+            for _ in range(count):
+                backend.set_nice(pid, nice)
+                backend.set_ioprio(pid, ioclass, ionice)
+            elapsed = time.perf_counter() - start
+            print("backend: {}, applies: {}, time: {:.3f}s, applies/s: {:.0f}".format(
+                backend.NAME, count, elapsed, count / elapsed), flush=True)
+
+    def replay(self, path, speed=0.0):
+        """ Feed trace written by record() through rule matching,
+        scheduler and apply_rules; tasks are ReplayTask and cgroups
+        SimulatedCgroup, so no task or cgroup of this system is
+        touched. speed - trace seconds per second, 0 - as fast as
+        possible
+        """
+        if not self.simulate:
+            raise Failure("replay needs Ananicy(simulate=True)")
+        events = []
+        with open(path) as _trace_file:
+            for line in _trace_file:
+                event = json.loads(line)
+                if "ev" in event:
+                    events.append(event)
+        self.apply_pool = None
+        self.scheduler = TaskScheduler(self.tick_budget)
+        latencies = []
+        matched = {}
+
+        def process(task):
+            key = self.get_tpid_rule_key(task) if task.exists() else None
+            if key:
+                matched[key] = matched.get(key, 0) + 1
+            self.process_tpid(task)
+            latencies.append(time.monotonic() - task.arrived)
+
+        tasks = 0
+        busy = 0.0
+        start = time.monotonic()
+        position = 0
+        while position < len(events) or len(self.scheduler):
+            now = time.monotonic()
+            new_tasks = []
+            while position < len(events):
+                event = events[position]
+                if speed > 0 and event["t"] / speed > now - start:
+                    break
+                # As fast as possible: tick per batch, exits end batch
+                # so short lived tasks get a chance to be matched
+                if speed <= 0 and new_tasks and (
+                        event["ev"] == "exit" or
+                        len(new_tasks) >= self.scheduler.per_tick):
+                    break
+                task = self.__replay_event(event, position)
+                if task:
+                    new_tasks.append(task)
+                position += 1
+            tasks += len(new_tasks)
+            self.scheduler.push(new_tasks, lambda task: True)
+            tick_start = time.monotonic()
+            self.scheduler.tick(process)
+            busy += time.monotonic() - tick_start
+            if speed > 0 and not len(self.scheduler) and \
+                    position < len(events):
+                time.sleep(max(0.0, events[position]["t"] / speed -
+                               (time.monotonic() - start)))
+
+        def percentile(share):
+            if not latencies:
+                return 0.0
+            latencies.sort()
+            return latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * share))] * 1000
+
+        print("replay: {} events, {} tasks, {} matched, {} rules hit".format(
+            len(events), tasks, sum(matched.values()), len(matched)))
+        print("processing: {:.3f}s, tasks/s: {:.0f}, wall: {:.3f}s".format(
+            busy, len(latencies) / busy if busy else 0,
+            time.monotonic() - start))
+        print("latency found -> applied, ms: p50 {:.3f}, p90 {:.3f}, "
+              "p99 {:.3f}, max {:.3f}".format(percentile(0.5), percentile(0.9),
+                                             percentile(0.99), percentile(1)))
+        for key, count in sorted(matched.items(),
+                                 key=lambda item: -item[1])[:10]:
+            print("  {}: {}".format(format_rule_key(key), count))
+        sys.stdout.flush()
+
+    def __replay_event(self, event, position):
+        """ Update proc map from trace event, return new ReplayTask
+        """
+        pid, tid = event["pid"], event["tid"]
+        if event["ev"] == "exit":
+            self.proc.pop((pid, tid), None)
+            if pid == tid:
+                self.rule_cache.pop(pid, None)
+                self.proc_ids.pop(pid, None)
+            return None
+        exe = event.get("exe") or ""
+        if event["ev"] in ("exec", "comm") or pid not in self.proc_ids:
+            self.rule_cache.pop(pid, None)
+            # position stands in for start time: exec is new image
+            self.proc_ids[pid] = (position, exe, event.get("comm"))
+        self.proc[(pid, tid)] = 0
+        return ReplayTask(pid, tid, exe, event.get("comm"),
+                          event.get("cmdline") or (), self.proc,
+                          verbose_opts=self.verbose)
+
+
+class FakeSystem:
+    """ Synthetic /proc and /sys/fs/cgroup/ trees for benchmarks:
+    processes x threads tasks with given (name, cmdline) pairs
+    """
+    # fields 3..52 of /proc/PID/stat, starttime is field 22
+    STAT = ("{pid} ({comm}) S 1 {pid} {pid} 0 -1 4194560 0 0 0 0 0 0 0 0 "
+            "20 0 {threads} 0 {start} 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 17 0 0 "
+            "0 0 0 0 0 0 0 0 0 0 0 0\n")
+
+    def __init__(self, root, names, processes, threads):
+        self.proc_fs = root + "/proc"
+        self.cgroup_fs = root + "/cgroup/"
+        os.makedirs(self.cgroup_fs + CgroupController.TYPE, exist_ok=True)
+        os.makedirs(self.proc_fs, exist_ok=True)
+        for i in range(processes):
+            pid = 1000 + i * threads
+            name, cmdline = names[i % len(names)]
+            proc = "{}/{}".format(self.proc_fs, pid)
+            os.makedirs(proc + "/task")
+            os.symlink("/usr/bin/" + name, proc + "/exe")
+            self.__task(proc, pid, name[:15], cmdline, threads, i)
+            with open(proc + "/autogroup", 'w') as fd:
+                fd.write("/autogroup-{} nice 0\n".format(i))
+            for tid in range(pid, pid + threads):
+                comm = name[:15] if tid == pid else "{}-{}".format(
+                    name[:9], tid - pid)
+                task = "{}/task/{}".format(proc, tid)
+                os.makedirs(task)
+                self.__task(task, tid, comm, cmdline, threads, i)
+                with open(task + "/oom_score_adj", 'w') as fd:
+                    fd.write("0\n")
+                with open(task + "/cgroup", 'w') as fd:
+                    fd.write("1:cpu:/\n0::/\n")
+
+    def __task(self, path, tid, comm, cmdline, threads, start):
+        with open(path + "/stat", 'w') as fd:
+            fd.write(self.STAT.format(pid=tid, comm=comm, threads=threads,
+                                      start=start))
+        with open(path + "/status", 'w') as fd:
+            fd.write("Name:\t{}\n".format(comm))
+        with open(path + "/cmdline", 'wb') as fd:
+            fd.write(b"\0".join(arg.encode() for arg in cmdline) + b"\0")
+
+    @staticmethod
+    def names_from_rules(rules):
+        """ Realistic mix: 2 of 3 processes have rules,
+        cmdlines taken from rules with plain cmdlines
+        """
+        names = []
+        misses = ("bash", "sh", "sshd", "cron", "python3", "containerd-shim")
+        for i, (name, cmdlines) in enumerate(sorted(
+                rules, key=lambda key: format_rule_key(key))):
+            cmdline = [name]
+            if cmdlines:
+                if any(map(is_cmdline_pattern, cmdlines)):
+                    continue
+                cmdline += sorted(cmdlines)
+            names.append((name, tuple(cmdline) + ("--option", "value")))
+            if i % 2:
+                miss = misses[i % len(misses)]
+                names.append((miss, (miss, "-c", "true")))
+        return names
+
+
+class ReplayTask(TPID):
+    """ TPID of recorded trace: names and cmdline come from trace,
+    attributes live in memory, applies only take APPLY_DELAY seconds
+    """
+    APPLY_DELAY = 0.0
+
+    __slots__ = ("comm", "args", "live", "arrived", "values", "paths")
+
+    def __init__(self, pid, tpid, exe, comm, cmdline, live, verbose_opts={}):
+        super().__init__(pid, tpid, verbose_opts=verbose_opts,
+                         exe="/" + exe, proc_fs="/nonexistent")
+        self.comm = comm
+        self.args = tuple(cmdline)
+        # Ananicy.proc of replay, task exited if key is gone
+        self.live = live
+        self.arrived = time.monotonic()
+        self.values = {"nice": 0, "oom_score_adj": 0}
+        self.paths = []
+
+    def exists(self):
+        return self.key in self.live
+
+    @property
+    def stat_name(self):
+        return self.comm
+
+    @property
+    def cmdline(self):
+        return self.args
+
+    @property
+    def cgroup_paths(self):
+        return self.paths
+
+    @property
+    def autogroup(self):
+        return None
+
+    def __set(self, attr, value):
+        if self.APPLY_DELAY:
+            time.sleep(self.APPLY_DELAY)
+        self.values[attr] = value
+        return True
+
+    def get_nice(self):
+        return self.values["nice"]
+
+    def get_ioprio(self):
+        return self.values.get("ioprio")
+
+    def get_sched(self):
+        return self.values.get("sched")
+
+    def get_oom_score_adj(self):
+        return self.values["oom_score_adj"]
+
+    def get_affinity(self):
+        return self.values.get("affinity")
+
+    def nice(self, nice):
+        return self.__set("nice", nice)
+
+    def ioclass(self, ioclass, ionice):
+        return self.__set("ioprio", ioprio_value(ioclass, ionice))
+
+    def sched(self, sched, rtprio):
+        return self.__set("sched", sched_value(sched, rtprio))
+
+    def oom_score_adj(self, oom_score_adj):
+        return self.__set("oom_score_adj", oom_score_adj)
+
+    def set_affinity(self, cpus):
+        return self.__set("affinity", set(cpus))
 
-        print(json.dumps(proc_autogroup, indent=4), flush=True)
+    def cgroups(self, cgroups):
+        for cgroup in cgroups:
+            self.paths.append((cgroup.TYPE, "/" + cgroup.name))
+        return self.__set("cgroups", cgroups)
+
+
+def record(path, seconds=60, config_dir="/etc/ananicy.d/"):
+    """ Write trace of tasks appearing and exiting for replay:
+    JSON lines of t (seconds since start), ev (exist, fork, exec,
+    comm, exit), pid, tid and for new tasks comm, exe basename and
+    cmdline; tasks running at start are "exist" at t 0
+    """
+    daemon = Ananicy(config_dir, daemon=False, simulate=True)
+    try:
+        connector = ProcConnector()
+    except OSError as e:
+        print("Proc connector unavailable ({}), poll /proc".format(e),
+              file=sys.stderr, flush=True)
+        connector = None
+    names = {ProcConnector.FORK: "fork", ProcConnector.EXEC: "exec",
+             ProcConnector.COMM: "comm"}
+    start = time.monotonic()
+    written = 0
+    with open(path, 'w') as trace:
+
+        def write(event, tpid, pid=None, tid=None):
+            nonlocal written
+            line = {"t": round(time.monotonic() - start, 6), "ev": event,
+                    "pid": tpid.pid if tpid else pid,
+                    "tid": tpid.tpid if tpid else tid}
+            if tpid:
+                try:
+                    line.update(comm=tpid.stat_name, exe=tpid.cmd,
+                                cmdline=tpid.cmdline)
+                except (OSError, UnicodeDecodeError):
+                    line.update(exe=tpid.cmd)
+            trace.write(json.dumps(line, separators=(',', ':')) + "\n")
+            written += 1
+
+        trace.write(json.dumps({"trace": 1, "kernel": platform.release(),
+                                "recorded": time.time()},
+                               separators=(",", ":")) + "\n")
+        for tpid in daemon.proc_map_update():
+            write("exist", tpid)
+        while time.monotonic() - start < seconds:
+            if connector is None:
+                time.sleep(0.1)
+                known = set(daemon.proc)
+                for tpid in daemon.proc_map_update():
+                    write("exec" if tpid.key in known else "fork", tpid)
+                for pid, tid in known - daemon.proc.keys():
+                    write("exit", None, pid, tid)
+                continue
+            timeout = seconds - (time.monotonic() - start)
+            ready, _, _ = select.select([connector], [], [], max(0, timeout))
+            if not ready:
+                continue
+            events = connector.read_events()
+            changed = {}
+            for event, pid, tid in events:
+                if event == ProcConnector.EXIT:
+                    write("exit", None, pid, tid)
+                else:
+                    changed[(pid, tid)] = names[event]
+            for tpid in daemon.proc_events_update(events):
+                write(changed.get(tpid.key, "fork"), tpid)
+    print("Recorded {} events in {:.1f}s to {}".format(
+        written, time.monotonic() - start, path), flush=True)
+
+
+def bench_system(config_dir, processes=500, threads=8, rounds=5):
+    """ Scan, lookup and config load speed on synthetic /proc tree
+    """
+    with tempfile.TemporaryDirectory(prefix="ananicy-bench-") as root:
+        proc_fs = root + "/proc"
+        cgroup_fs = root + "/cgroup/"
+        os.makedirs(cgroup_fs + CgroupController.TYPE)
+        rules_cache = root + "/rules.cache"
+
+        start = time.perf_counter()
+        Ananicy(config_dir, daemon=False, proc_fs=proc_fs,
+                cgroup_fs=cgroup_fs, rules_cache="")
+        parse_time = time.perf_counter() - start
+        Ananicy(config_dir, daemon=False, proc_fs=proc_fs,
+                cgroup_fs=cgroup_fs, rules_cache=rules_cache)
+        start = time.perf_counter()
+        daemon = Ananicy(config_dir, daemon=False, proc_fs=proc_fs,
+                         cgroup_fs=cgroup_fs, rules_cache=rules_cache)
+        cache_time = time.perf_counter() - start
+        print("config load: parse {:.3f}s, cached {:.3f}s, rules: {}".format(
+            parse_time, cache_time, len(daemon.rules)), flush=True)
+
+        start = time.perf_counter()
+        FakeSystem(root, FakeSystem.names_from_rules(daemon.rules), processes,
+                   threads)
+        print("fake system: {} processes x {} threads, built in {:.3f}s".format(
+            processes, threads, time.perf_counter() - start), flush=True)
+
+        # Every task new: what startup or fork storm costs
+        elapsed = 0
+        lookup_time = 0
+        lookups = 0
+        matched = 0
+        for _ in range(rounds):
+            daemon.forget_proc()
+            start = time.perf_counter()
+            new_tpids = daemon.proc_map_update()
+            elapsed += time.perf_counter() - start
+            start = time.perf_counter()
+            for tpid in new_tpids:
+                if daemon.get_tpid_rule_key(tpid):
+                    matched += 1
+            lookup_time += time.perf_counter() - start
+            lookups += len(new_tpids)
+        print("cold scan: {} tasks, scans/s: {:.2f}, tasks/s: {:.0f}".format(
+            len(daemon.proc), rounds / elapsed, lookups / elapsed), flush=True)
+        print("rule lookups: {}, matched: {}, lookups/s: {:.0f}".format(
+            lookups, matched, lookups / lookup_time), flush=True)
+
+        # What stays in memory per thread between scans
+        daemon.forget_proc()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for tpid in daemon.proc_map_update():
+            daemon.get_tpid_rule_key(tpid)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("memory per tracked thread: {:.0f} bytes, TPID object: {} bytes".format(
+            (after - before) / len(daemon.proc),
+            sys.getsizeof(TPID(1, 1, exe="/bin/true"))), flush=True)
+
+        # Nothing new: cost of periodic scan on idle system
+        start = time.perf_counter()
+        for _ in range(rounds):
+            daemon.proc_map_update()
+        elapsed = time.perf_counter() - start
+        print("steady scan: scans/s: {:.2f}".format(rounds / elapsed),
+              flush=True)
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print("peak RSS: {:.1f} MiB (ananicy.service MemoryHigh=16M)".format(
+            peak_rss), flush=True)
+
+
+def dump(request, config_dir="/etc/ananicy.d/"):
+    """ Print answer of running daemon, without one build it locally
+    """
+    path = ControlServer.PATH
+    try:
+        with open(config_dir + "ananicy.conf") as _config_file:
+            for line in _config_file:
+                line = line.split('#')[0].strip()
+                if line.startswith("control="):
+                    path = line.split('=', 1)[1].strip('"')
+    except OSError:
+        pass
+    if path:
+        try:
+            for line in control_query(path, request):
+                sys.stdout.write(line)
+            sys.stdout.flush()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("Daemon not running, scan locally", file=sys.stderr,
+                  flush=True)
+    Ananicy(config_dir, daemon=False).dump(request)
 
 
 def help():
     print(
         "Usage: ananicy [options]\n",
         "  start          Run script\n",
-        "  dump rules     Generate and print rules cache to stdout\n",
-        "  dump types     Generate and print types cache to stdout\n",
-        "  dump cgroups   Generate and print cgroups cache to stdout\n",
-        "  dump proc      Generate and print proc map cache to stdout\n",
-        "  dump autogroup Generate and print autogroup tree",
+        "  dump rules     Print rules with hit counts as JSON lines\n",
+        "  dump types     Print types as JSON lines\n",
+        "  dump cgroups   Print cgroups as JSON lines\n",
+        "  dump proc [PID]\n",
+        "                 Print matched rules and applied state per process\n",
+        "  dump autogroup Print autogroups with their processes\n",
+        "  dump stats     Print daemon queue and map sizes\n",
+        "                 dump asks running daemon, else scans once itself\n",
+        "  compile        Parse types/rules and write rules cache\n",
+        "  record FILE [SECONDS]\n",
+        "                 Write trace of tasks appearing/exiting\n",
+        "  replay FILE [SPEED [APPLY_US]]\n",
+        "                 Run trace through matching and scheduler with\n",
+        "                 simulated applies; SPEED 0 - as fast as possible\n",
+        "  bench rules    Measure rule lookups per second\n",
+        "  bench apply    Compare nice/ioprio applies per second per backend\n",
+        "  bench system [PROCESSES [THREADS [CONFIG_DIR]]]\n",
+        "                 Scan/lookup/load speed and RSS on synthetic /proc",
         flush=True)
     exit(0)
 
@@ -847,19 +3903,42 @@ def main(argv):
             daemon.run()
 
         if argv[1] == "dump":
+            if len(argv) < 3:
+                help()
+            dump(argv[2:])
+
+        if argv[1] == "compile":
             daemon = Ananicy(daemon=False)
+            if daemon.rules_cache:
+                if not daemon.rules_cache_valid:
+                    sys.exit(1)
+                print("Rules cache: {}".format(daemon.rules_cache), flush=True)
+
+        if argv[1] == "record":
+            if len(argv) < 3:
+                help()
+            record(argv[2], float(argv[3]) if len(argv) > 3 else 60)
+
+        if argv[1] == "replay":
+            if len(argv) < 3:
+                help()
+            if len(argv) > 4:
+                ReplayTask.APPLY_DELAY = float(argv[4]) / 1000000
+            Ananicy(daemon=False, simulate=True).replay(
+                argv[2], float(argv[3]) if len(argv) > 3 else 0)
+
+        if argv[1] == "bench":
             if len(argv) < 3:
                 help()
             if argv[2] == "rules":
-                daemon.dump_rules()
-            if argv[2] == "types":
-                daemon.dump_types()
-            if argv[2] == "cgroups":
-                daemon.dump_cgroups()
-            if argv[2] == "proc":
-                daemon.dump_proc()
-            if argv[2] == "autogroup":
-                daemon.dump_autogroup()
+                Ananicy(daemon=False).bench_rules()
+            if argv[2] == "apply":
+                Ananicy(daemon=False).bench_apply()
+            if argv[2] == "system":
+                args = argv[3:]
+                bench_system(args[2] if len(args) > 2 else "/etc/ananicy.d/",
+                             processes=int(args[0]) if args else 500,
+                             threads=int(args[1]) if len(args) > 1 else 8)
     except PermissionError as e:
         print("You are root?: {}".format(e))
 